@@ -1,155 +1,488 @@
-import json
-import re
 from packaging.version import Version, InvalidVersion
-import click
+import sys
 from sys import exit
 import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
 
-from parsers import TreeSitterParser, RegexParser, format_pattern_string
-from utils import File, hash_message, Color as color
+from parsers import TreeSitterParser, SinglePassTreeSitterParser, RegexParser
+from rules import RuleSet
+from findings import Finding
+from renderers import get_renderer
+from cache import ScanCache
+from profiling import MemoryTracer, Profiler, SlowFiles
+from prefilter import clauses_satisfied
+from utils import File, IgnoreStore, decode, hash_message, prefetch, Color as color
+
+
+# files read ahead of the one being scanned, in sequential scans
+READ_AHEAD = 8
+# files in flight per worker process, in parallel scans
+FILES_PER_WORKER = 4
 
 
 class DriverMigrationAssistant:
 
-    def __init__(self, language_name, context_lines, version, no_output_colors, regex_parser):
+    def __init__(self, language_name, context_lines, version, output_style, regex_parser, single_pass=False,
+                 cache_dir=None, cache_max_size=0, max_file_size=0, regex_fallback=False, profile=False,
+                 slowest=0, trace_memory=False, driver_files_only=False, prefilter=True):
+        '''
+        output_style: renderer for the text report, one of
+        auto (ANSI colors on terminals only), plain, ansi, html.
+        profile: time each phase of the scan and each changelog pattern.
+        slowest: number of slowest files to keep track of.
+        trace_memory: measure peak memory per phase and per file (sequential scans only).
+        driver_files_only: don't parse files that don't import the driver.
+        prefilter: skip files and patterns whose literals don't occur in the file.
+        Only disabled to check that findings are the same without it.
+        '''
+        # to rebuild an equivalent assistant in worker processes
+        self.init_args = (language_name, context_lines, version, output_style, regex_parser, single_pass,
+                          cache_dir, cache_max_size, max_file_size, regex_fallback, profile, slowest,
+                          trace_memory, driver_files_only, prefilter)
         self.language_name = language_name
         self.context_lines = context_lines
-        self.no_output_colors = no_output_colors
+        self.output = sys.stdout
+        self.renderer = get_renderer(output_style, self.output)
         try:
             self.version = Version(version)
         except InvalidVersion as e:
             print(f'Version `{version}` is not a valid PEP 440 version.')
             exit(1)
+        self.rules = RuleSet(language_name, self.version)
         if regex_parser:
-            self.parser = RegexParser()
+            self.parser = RegexParser(self.rules)
+        elif single_pass:
+            self.parser = SinglePassTreeSitterParser(language_name, self.rules)
         else:
             self.parser = TreeSitterParser(language_name)
+        self.max_file_size = max_file_size
+        # tree-sitter parses are worth avoiding for files no pattern can match
+        self.gate_files = isinstance(self.parser, TreeSitterParser) and (prefilter or driver_files_only)
+        self.driver_files_only = driver_files_only
+        self.prefilter = prefilter
+        self.parser.prefilter = prefilter
+        self.found_literals = None
+        # files not worth a tree-sitter parse get the regex parser, if enabled
+        self.fallback_parser = None
+        if regex_fallback:
+            self.fallback_parser = self.parser if regex_parser else RegexParser(self.rules)
+        self.profiler = Profiler() if profile else None
+        self.slow_files = SlowFiles(slowest, language_name) if slowest > 0 else None
+        self.memory_tracer = MemoryTracer() if trace_memory else None
+        self.parser.profiler = self.profiler
+        if self.fallback_parser != None:
+            self.fallback_parser.profiler = self.profiler
+        self.ignored = IgnoreStore(os.path.join(os.path.dirname(__file__), 'ignore.db'))
+        self.cache = None
+        if cache_dir != None:
+            parser_mode = 'regex' if regex_parser else 'tree-sitter'
+            self.cache = ScanCache(cache_dir, cache_max_size, self.rules.digest, self.version, parser_mode)
+
+    def scan_files(self, file_paths, jobs=1):
+        '''
+        Process files in order, yielding (source, findings) for each as soon
+        as it's ready. `file_paths` may be a lazy iterable, and is consumed
+        no faster than files are processed, so memory doesn't grow with the
+        number of files.
+
+        Sequentially, paths are walked and files are read in a background
+        thread, at most READ_AHEAD files ahead of the one being scanned.
+        With jobs > 1, files are processed by a pool of worker processes,
+        each with its own parser and rule set, with at most FILES_PER_WORKER
+        files per worker in flight; results are still yielded in the order
+        of file_paths.
+        '''
+        if self.profiler != None:
+            file_paths = self.profiler.timed_iter('walk', file_paths)
+        if self.memory_tracer != None:
+            yield from self.scan_files_traced(file_paths)
+            return
+        if jobs <= 1:
+            for source in prefetch((self.read_file(file_path) for file_path in file_paths), READ_AHEAD):
+                findings = self.process_source(source)
+                if self.slow_files != None:
+                    self.slow_files.add(source, len(findings))
+                yield source, findings
+            return
+
+        with ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=self.init_args) as pool:
+            file_paths = iter(file_paths)
+            in_flight = deque()
+            for file_path in file_paths:
+                in_flight.append(pool.submit(_process_file, file_path))
+                if len(in_flight) == jobs * FILES_PER_WORKER:
+                    break
+            while len(in_flight) > 0:
+                source, findings, profile = in_flight.popleft().result()
+                if profile != None:
+                    self.profiler.merge(profile)
+                for file_path in file_paths:  # refill before handing over
+                    in_flight.append(pool.submit(_process_file, file_path))
+                    break
+                self.source = source
+                if self.slow_files != None:
+                    self.slow_files.add(source, len(findings))
+                yield source, findings
+
+    def scan_files_traced(self, file_paths):
+        '''
+        Same as a sequential scan_files, without reading ahead, so that
+        the memory tracer can attribute allocations to each file.
+        Rendering is traced while the caller handles the yielded findings.
+        '''
+        tracer = self.memory_tracer
+        for file_path in file_paths:
+            tracer.begin_file()
+            state = tracer.begin()
+            source = self.read_file(file_path)
+            tracer.end('load', state)
+            findings = self.process_source(source)
+            if self.slow_files != None:
+                self.slow_files.add(source, len(findings))
+            state = tracer.begin()
+            yield source, findings
+            tracer.end('render', state)
+            tracer.end_file(source, len(findings))
 
     def process_file(self, file_path):
-        self.source = File(file_path)
-        self.parser.set_source(self.source)
-        messages = []
+        return self.process_source(self.read_file(file_path))
+
+    def read_file(self, file_path):
+        if self.profiler == None:
+            return File(file_path)
+        start = perf_counter()
+        source = File(file_path)
+        self.profiler.add('read', start)
+        return source
 
-        changes_json = json.loads(open(
-            os.path.join(os.path.dirname(__file__), 'changelogs', f'{self.language_name}.json')
-        ).read())
+    def process_source(self, source):
+        self.source = source
+        self.found_literals = None
+        scan_start = perf_counter()
+        profiler = self.profiler
+        if profiler != None:
+            profiler.files += 1
+            start = perf_counter()
+        skip_reason = self.source.sniff(self.max_file_size)
+        if profiler != None:
+            profiler.add('sniff', start)
+        if skip_reason != None and (skip_reason == 'binary' or self.fallback_parser == None):
+            self.source.skipped = skip_reason
+            self.source.scan_seconds = perf_counter() - scan_start
+            return []
 
-        for change in changes_json:
-            captures = []
-            for pattern in change['patterns']:
-                captures += self.parser.get_captures_for_pattern(pattern, change)
+        if skip_reason == None and self.gate_files:
+            if profiler != None:
+                start = perf_counter()
+            self.source.relevant = self.is_relevant()
+            if profiler != None:
+                profiler.add('prefilter', start)
+            if not self.source.relevant:
+                self.source.scan_seconds = perf_counter() - scan_start
+                return []
 
-            for capture in captures:
-                msg = self.process_capture(capture[0], capture[1], change)
-                if msg != False:
-                    messages.append(msg)
+        if skip_reason != None:
+            self.source.downgraded = skip_reason
+            captures = self.find_captures(self.fallback_parser)
+        elif self.cache != None:
+            if profiler != None:
+                start = perf_counter()
+            cache_key = self.cache.key(self.source.data)
+            captures = self.cache.get(cache_key)
+            if profiler != None:
+                profiler.add('cache', start)
+                profiler.count('findings cache misses' if captures == None else 'findings cache hits')
+            if captures == None:
+                captures = self.find_captures()
+                if profiler != None:
+                    start = perf_counter()
+                self.cache.set(cache_key, captures)
+                if profiler != None:
+                    profiler.add('cache', start)
+        else:
+            captures = self.find_captures()
+
+        if profiler != None:
+            start = perf_counter()
+        findings = []
+        for identifier, start_point, end_point in captures:
+            if self.source.is_suppressed(start_point[0], identifier):
+                continue
+            findings.append(self.process_capture(tuple(start_point), tuple(end_point), self.rules.get(identifier)))
 
-        self.source.deprecated_count += self.count_deprecations(messages)
-        self.source.removed_count += self.count_removals(messages)
+        self.source.deprecated_count += self.count_deprecations(findings)
+        self.source.removed_count += self.count_removals(findings)
 
-        # sort msgs by source line number; break ties by starting col number
-        messages.sort(key=lambda msg: (msg['meta']['line'], msg['meta']['col_start']))
-        return messages
+        findings.sort(key=Finding.sort_key)
+        if profiler != None:
+            profiler.add('findings', start)
+        self.source.scan_seconds = perf_counter() - scan_start
+        return findings
 
-    def process_capture(self, start_point, end_point, change):
+    def is_relevant(self):
         '''
-        Craft a user friendly message from a raw capture.
+        Cheap check, before parsing, of whether any changelog pattern can
+        match the current source: whether all the literals of some pattern
+        occur in it. With driver_files_only, the source must also contain
+        the driver's import marker.
+        '''
+        if self.driver_files_only and not self.parser.imports_driver(self.source):
+            return False
+        if not self.prefilter:
+            return True
+        found = self.literals_in_source()
+        for rule in self.rules:
+            for literals in rule.literals:
+                if clauses_satisfied(literals, found):
+                    return True
+        return False
+
+    def literals_in_source(self):
+        '''
+        Changelog literals occurring in the current source, found once per file.
+        '''
+        if self.found_literals == None:
+            self.found_literals = self.rules.literal_matcher.find(self.source.data)
+        return self.found_literals
+
+    def find_captures(self, parser=None):
+        '''
+        Run every rule against the current source, with the assistant's parser
+        unless another is given.
+        Return raw captures as a list of (identifier, start_point, end_point),
+        in rule order. When profiling, the prefilter and each pattern query
+        are timed.
+        '''
+        parser = parser or self.parser
+        tracer = self.memory_tracer
+        if tracer != None:
+            state = tracer.begin()
+        parser.set_source(self.source)
+        if tracer != None:
+            tracer.end('tree', state)
+            state = tracer.begin()
+
+        # parsers that match all patterns while setting the source time that as a whole
+        profiler = self.profiler if not parser.matches_all_patterns else None
+        if profiler != None:
+            start = perf_counter()
+        found = None
+        if not parser.matches_all_patterns and self.prefilter:
+            # only query patterns whose literals occur in the file
+            found = self.literals_in_source()
+        if profiler != None:
+            begin = start = profiler.add('prefilter', start)
+        captures = []
+        for rule in self.rules:
+            for i, (pattern, literals) in enumerate(zip(rule.patterns, rule.literals)):
+                if found != None and not clauses_satisfied(literals, found):
+                    continue
+                for start_point, end_point in parser.get_captures_for_pattern(pattern, rule.change):
+                    captures.append((rule.identifier, start_point, end_point))
+                if profiler != None:
+                    start = profiler.add_pattern(rule.identifier, i, pattern.get('ts_type'), start)
+        if profiler != None:
+            profiler.add('queries', begin)
+        if tracer != None:
+            tracer.end('captures', state)
+        return captures
+
+    def process_capture(self, start_point, end_point, rule):
+        '''
+        Turn a raw capture into a finding.
 
         start_point: tuple of (row, col) where hit starts.
         end_point: tuple of (row, col) where hit ends.
-        change: change entry from which hit resulted.
+        rule: compiled change entry from which hit resulted.
+        '''
+        line_n = start_point[0]
+        finding = Finding(
+            rule.identifier, self.source.path, line_n,
+            self.source.char_col(line_n, start_point[1]), self.source.char_col(line_n, end_point[1]),
+            start_point[1], end_point[1],
+            rule.deprecated, rule.removed)
+        finding.hash = hash_message(finding, self.source)
+        return finding
+
+    def render_finding(self, finding, source):
+        '''
+        Craft a user friendly message from a finding in `source`.
         '''
+        start = perf_counter()
+        rule = self.rules.get(finding.change_id)
+        output = self.renderer.style(rule.msg + '\n\n', fg=self.msg_color(rule), bold=True)
+        output += self.render_lines(
+            source,
+            max(finding.line - self.context_lines, 0),
+            min(finding.line + self.context_lines + 1, source.line_count()),
+            {finding.line: [finding]})
+        output += self.render_refs(rule, '  ')
+        output += '\n'
+        if self.profiler != None:
+            self.profiler.add('render', start)
+        return output
+
+    def group_findings(self, findings):
+        '''
+        Split findings, sorted by position, into groups whose context windows
+        overlap or touch, as grep -C does, so each group can be shown as one
+        block of source.
+        '''
+        groups = []
+        for finding in findings:
+            if groups != [] and finding.line - groups[-1][-1].line <= 2 * self.context_lines + 1:
+                groups[-1].append(finding)
+            else:
+                groups.append([finding])
+        return groups
+
+    def render_group(self, findings, source):
+        '''
+        Craft a single message for a group of findings in `source`: the
+        distinct changes they hit, each labeled, followed by the merged
+        source window with every hit highlighted and tagged with its labels.
+        '''
+        start = perf_counter()
+        style = self.renderer.style
+        labels = {}
         output = ''
+        for finding in findings:
+            if finding.change_id in labels:
+                continue
+            rule = self.rules.get(finding.change_id)
+            labels[finding.change_id] = f'[{len(labels)+1}]'
+            output += style(labels[finding.change_id] + ' ' + rule.msg, fg=self.msg_color(rule), bold=True)
+            output += self.render_refs(rule, '    ') + '\n'
+        output += '\n'
 
-        if not self.is_removed(change) and not self.is_deprecated(change):
-            return False
-        if self.is_deprecated(change):
-            msg_color = color.deprecated
-        if self.is_removed(change):
-            msg_color = color.removed
-        output += click.style(change['msg'].format(**change) + '\n\n', fg=msg_color, bold=True)
-
-        matched_line_n = start_point[0]
-        for i in range(
-            max(matched_line_n - self.context_lines, 0),
-            min(matched_line_n + self.context_lines + 1, len(self.source.lines))
-        ):
-            if i == matched_line_n:
-                # highlight the matched text
-                match_start = start_point[1]
-                match_end = end_point[1]
-                line_content = self.source.lines[i][:match_start]
-                line_content += click.style(self.source.lines[i][match_start:match_end], bg=color.code_highlight)
-                line_content += self.source.lines[i][match_end:]
+        hits_by_line = {}
+        for finding in findings:
+            hits_by_line.setdefault(finding.line, []).append(finding)
+        tags_by_line = {}
+        for line_n, hits in hits_by_line.items():
+            tags = []
+            for finding in hits:
+                if labels[finding.change_id] not in tags:
+                    tags.append(labels[finding.change_id])
+            tags_by_line[line_n] = ''.join(tags)
+
+        output += self.render_lines(
+            source,
+            max(findings[0].line - self.context_lines, 0),
+            min(findings[-1].line + self.context_lines + 1, source.line_count()),
+            hits_by_line, tags_by_line)
+        if self.profiler != None:
+            self.profiler.add('render', start)
+        return output
+
+    def render_lines(self, source, first_line, end_line, hits_by_line, tags_by_line=None):
+        '''
+        Source lines [first_line, end_line), numbered, with hit lines marked
+        and their matched text highlighted.
+        '''
+        style = self.renderer.style
+        escape = self.renderer.escape
+        output = ''
+        for i in range(first_line, end_line):
+            if i in hits_by_line:
+                # highlight the matched text; columns are in bytes
+                line = source.line_bytes(i)
+                line_content = ''
+                pos = 0
+                for start, end in merge_spans((f.byte_start, f.byte_end) for f in hits_by_line[i]):
+                    line_content += escape(decode(line[pos:start]))
+                    line_content += style(decode(line[start:end]), bg=color.code_highlight)
+                    pos = end
+                line_content += escape(decode(line[pos:]))
+                if tags_by_line != None and i in tags_by_line:
+                    line_content += '  ' + style(tags_by_line[i], bold=True)
                 output += '> '  # text-highlight offending line
             else:
-                line_content = self.source.lines[i]
+                line_content = escape(source.line(i))
                 output += '  '
-            output += click.style(i+1, bold=True) + ' ' + line_content + '\n'
-
-        if change.get('deprecated') != None:
-            output += '\n  ' + click.style('Deprecated in: ', bold=True) + change.get('deprecated')
-        if change.get('removed') != None:
-            output += '\n  ' + click.style('Removed in: ', bold=True) + change.get('removed')
-        if change.get('ref') != None:
-            refs = change.get('ref')
-            if isinstance(refs, str):
-                refs = [refs, ]  # make iterable
-            for link in refs:
-                output += '\n  ' + click.style('Docs: ', bold=True) + link
-        output += '\n'
+            output += style(i+1, bold=True) + ' ' + line_content + '\n'
+        return output
 
-        return {
-            'meta': {
-                'change_id': change.get('identifier'),
-                'line': matched_line_n,
-                'col_start': start_point[1],
-                'col_end': end_point[1],
-                'deprecated': self.is_deprecated(change),
-                'removed': self.is_removed(change)
-            },
-            'content': output
-        }
-
-    def count_deprecations(self, messages):
-        return sum(msg['meta']['deprecated'] for msg in messages)
+    def render_refs(self, rule, indent):
+        style = self.renderer.style
+        escape = self.renderer.escape
+        output = ''
+        if rule.change.get('deprecated') != None:
+            output += '\n' + indent + style('Deprecated in: ', bold=True) + escape(rule.change.get('deprecated'))
+        if rule.change.get('removed') != None:
+            output += '\n' + indent + style('Removed in: ', bold=True) + escape(rule.change.get('removed'))
+        for link in rule.refs:
+            output += '\n' + indent + style('Docs: ', bold=True) + escape(link)
+        return output
 
-    def count_removals(self, messages):
-        return sum(msg['meta']['removed'] for msg in messages)
+    def msg_color(self, rule):
+        if rule.removed:
+            return color.removed
+        return color.deprecated
 
-    def is_deprecated(self, change):
-        return (change.get('deprecated') != None and
-               Version(change['deprecated']) <= self.version)
+    def count_deprecations(self, findings):
+        return sum(finding.deprecated for finding in findings)
 
-    def is_removed(self, change):
-        return (change.get('removed') != None and
-               Version(change['removed']) <= self.version)
+    def count_removals(self, findings):
+        return sum(finding.removed for finding in findings)
 
     def print_msg(self, message):
-        if self.no_output_colors:
-            # see ANSI escape sequences https://stackoverflow.com/a/33206814
-            message = re.sub(r'(3|4|9|10)[0-7]', '', message)
-        # click.echo removes all ANSI codes when output to file
-        click.echo(message)
-
-    def set_ignore_msg(self, message):
-        if not self.is_ignored_msg(message):  # no double entries
-            f = open(os.path.join(os.path.dirname(__file__), 'ignore.db'), 'a')
-            f.write(hash_message(message, self.source) + '\n')
-
-    def is_ignored_msg(self, message):
-        try:
-            f = open(os.path.join(os.path.dirname(__file__), 'ignore.db'), 'r')
-        except:
-            return False
+        # buffered; flushed after each file and before prompts
+        if self.profiler == None:
+            self.output.write(message + '\n')
+            return
+        start = perf_counter()
+        self.output.write(message + '\n')
+        self.profiler.add('output', start)
 
-        hashes = [h.strip() for h in f.readlines()]
-        if hash_message(message, self.source) in hashes:
-            # Ignored msgs shouldn't count in counters
-            if message['meta']['removed']:
-                self.source.removed_count -= 1
-            if message['meta']['deprecated']:
-                self.source.deprecated_count -= 1
-            return True
+    def set_ignore_msg(self, finding):
+        self.ignored.add(finding.hash)
 
-        return False
+    def is_ignored_msg(self, finding):
+        if self.profiler == None:
+            return finding.hash in self.ignored
+        start = perf_counter()
+        ignored = finding.hash in self.ignored
+        self.profiler.add('ignore', start)
+        return ignored
+
+    def uncount_msg(self, finding):
+        '''
+        Remove a finding from the current file's counters.
+        Ignored msgs shouldn't count in counters.
+        '''
+        if finding.removed:
+            self.source.removed_count -= 1
+        if finding.deprecated:
+            self.source.deprecated_count -= 1
+
+
+def merge_spans(spans):
+    '''
+    Sort (start, end) spans and merge the overlapping ones.
+    '''
+    merged = []
+    for start, end in sorted(spans):
+        if merged != [] and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+_worker_assistant = None
+
+
+def _init_worker(*init_args):
+    global _worker_assistant
+    _worker_assistant = DriverMigrationAssistant(*init_args)
+
+
+def _process_file(file_path):
+    findings = _worker_assistant.process_file(file_path)
+    profile = None
+    if _worker_assistant.profiler != None:
+        profile = _worker_assistant.profiler.drain()
+    return _worker_assistant.source, findings, profile
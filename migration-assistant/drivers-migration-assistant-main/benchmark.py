@@ -0,0 +1,413 @@
+import click
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from multiprocessing import get_context
+from packaging.version import Version
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from assistant import DriverMigrationAssistant
+from parsers import format_pattern_string
+from prefilter import sre_constants, sre_parse
+from rules import RuleSet
+from selection import FileSelector
+from utils import parse_path
+
+
+# Lines triggering each pattern type, per language. Placeholders are filled
+# with strings sampled from the pattern's ts_pattern regexes, in order.
+# Go imports go in the file header, all other lines in a function body.
+HIT_TEMPLATES = {
+    'python': {
+        'function': '{0}(value)',
+        'method': 'session.{0}()',
+        'property': 'value = record.{0}',
+        'type': 'value: {0} = None',
+        'import_from_statement__module_name': 'from {0} import value',
+        'import_from_statement__name': 'from {0} import {1}',
+        'import_statement__name': 'import {0}',
+        'method__kwarg': 'neo4j.{0}(uri, {1}=value)',
+        'function__kwarg': '{0}({1}=value)',
+        'function__kwarg__type': '{0}({1}={2})',
+        'method__kwarg__type': 'neo4j.{0}({1}={2})',
+    },
+    'go': {
+        'function': '\tvalue, err = {0}()',
+        'method': '\tvalue, err = session.{0}()',
+        'property': '\tvalue = record.{0}',
+        'type': '\tvar value {0}',
+        'import_dec': 'import "github.com/neo4j/neo4j-go-driver{0}"',
+        'function_arg': '\tvalue = neo4j.{0}({1})',
+    },
+    'javascript': {
+        'function': 'value = {0}()',
+        'method': 'value = session.{0}()',
+        'property': 'value = record.{0}',
+        'function_arg': 'value = neo4j.{0}({1})',
+    },
+}
+
+# Lines that trigger nothing, to pad files up to the requested size.
+FILLER_TEMPLATES = {
+    'python': [
+        'value_{n} = compute(value, "text {n}")',
+        'if value_{n} is not None:\n    results.append(value_{n})',
+        'def helper_{n}(items):\n    return [item * {n} for item in items]',
+        '# a comment about step {n}',
+    ],
+    'go': [
+        '\tvalue{n} := compute(value, "text {n}")',
+        '\tif value{n} != nil {{\n\t\tresults = append(results, value{n})\n\t}}',
+        '\tfor i := 0; i < {n}; i++ {{\n\t\ttotal += i\n\t}}',
+        '\t// a comment about step {n}',
+    ],
+    'javascript': [
+        'const value{n} = compute(value, "text {n}")',
+        'if (value{n} !== null) {{\n  results.push(value{n})\n}}',
+        'function helper{n} (items) {{\n  return items.map(item => item * {n})\n}}',
+        '// a comment about step {n}',
+    ],
+}
+
+FILE_HEADERS = {
+    'python': 'import neo4j\n\n\n',
+    'go': 'package main\n\nimport (\n\t"github.com/neo4j/neo4j-go-driver/v5/neo4j"\n'
+          '\t"github.com/neo4j/neo4j-go-driver/v5/neo4j/db"\n'
+          '\t"github.com/neo4j/neo4j-go-driver/v5/neo4j/log"\n)\n\n',
+    'javascript': "const neo4j = require('neo4j-driver')\n\n",
+}
+FUNCTION_OPEN = {'go': 'func run() {\n'}
+FUNCTION_CLOSE = {'go': '}\n'}
+
+EXTENSIONS = {'python': '.py', 'go': '.go', 'javascript': '.js'}
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example-projects')
+BACKENDS = ('tree-sitter', 'regex')
+
+
+class CorpusGenerator:
+    '''
+    Writes synthetic source files for a language, with hits for the
+    changelog entries in effect at `version` spread among neutral lines.
+
+    hit_density is the fraction of lines that trigger a changelog entry.
+    '''
+
+    def __init__(self, language_name, version, file_size, hit_density, seed):
+        self.language_name = language_name
+        self.file_size = file_size
+        self.hit_density = hit_density
+        self.random = random.Random(seed)
+        self.hit_lines = []
+        self.header_hit_lines = []
+        templates = HIT_TEMPLATES[language_name]
+        for rule in RuleSet(language_name, version):
+            for pattern in rule.patterns:
+                template = templates.get(pattern['ts_type'])
+                if template == None:
+                    continue
+                ts_patterns = pattern['ts_pattern']
+                if isinstance(ts_patterns, str):
+                    ts_patterns = [ts_patterns, ]
+                samples = [sample_regex(format_pattern_string(p, rule.change, {}), self.random)
+                           for p in ts_patterns]
+                if pattern['ts_type'] == 'import_dec':
+                    self.header_hit_lines.append(template.format(*samples))
+                else:
+                    self.hit_lines.append(template.format(*samples))
+
+    def generate(self, directory, files_count):
+        '''
+        Write `files_count` files into `directory`, and return their paths
+        and total size in bytes.
+        '''
+        paths = []
+        total_size = 0
+        for i in range(files_count):
+            path = os.path.join(directory, f'file_{i}{EXTENSIONS[self.language_name]}')
+            content = self.file_content().encode()
+            with open(path, 'wb') as f:
+                f.write(content)
+            paths.append(path)
+            total_size += len(content)
+        return paths, total_size
+
+    def file_content(self):
+        header = FILE_HEADERS[self.language_name]
+        if self.header_hit_lines != [] and self.random.random() < self.hit_density:
+            header += self.random.choice(self.header_hit_lines) + '\n\n'
+        header += FUNCTION_OPEN.get(self.language_name, '')
+        footer = FUNCTION_CLOSE.get(self.language_name, '')
+
+        lines = []
+        size = len(header) + len(footer)
+        fillers = FILLER_TEMPLATES[self.language_name]
+        n = 0
+        while size < self.file_size:
+            if self.hit_lines != [] and self.random.random() < self.hit_density:
+                line = self.random.choice(self.hit_lines)
+            else:
+                line = self.random.choice(fillers).format(n=n)
+            lines.append(line)
+            size += len(line) + 1
+            n += 1
+        return header + '\n'.join(lines) + '\n' + footer
+
+
+def sample_regex(regex, rand):
+    '''
+    A short string matched by `regex`. Patterns of tree-sitter queries are
+    escaped for query strings, so doubled backslashes are undone first.
+    '''
+    parsed = sre_parse.parse(regex.replace('\\\\', '\\'))
+    return _sample_tokens(parsed, rand)
+
+
+def _sample_tokens(tokens, rand):
+    constants = sre_constants
+    output = ''
+    for op, arg in tokens:
+        if op == constants.LITERAL:
+            output += chr(arg)
+        elif op == constants.ANY:
+            output += '.'  # most often an unescaped dot in a dotted name
+        elif op == constants.IN:
+            output += _sample_set(arg)
+        elif op == constants.CATEGORY:
+            output += _sample_set([(op, arg)])
+        elif op == constants.BRANCH:
+            output += _sample_tokens(rand.choice(arg[1]), rand)
+        elif op == constants.SUBPATTERN:
+            output += _sample_tokens(arg[-1], rand)
+        elif op in (constants.MAX_REPEAT, constants.MIN_REPEAT):
+            min_count, max_count, item = arg
+            if list(item) == [(constants.ANY, None)]:
+                output += 'a' * max(min_count, 1)
+                continue
+            count = min_count
+            if min_count == 0:
+                count = rand.randint(0, min(max_count, 1))
+            output += ''.join(_sample_tokens(item, rand) for _ in range(count))
+        # anchors and word boundaries match no characters
+    return output
+
+
+def _sample_set(items):
+    constants = sre_constants
+    for op, arg in items:
+        if op == constants.LITERAL:
+            return chr(arg)
+        if op == constants.RANGE:
+            return chr(arg[0])
+        if op == constants.CATEGORY:
+            return {
+                constants.CATEGORY_DIGIT: '0',
+                constants.CATEGORY_SPACE: ' ',
+                constants.CATEGORY_WORD: 'a',
+            }.get(arg, 'a')
+    return 'a'
+
+
+def peak_memory():
+    '''
+    Peak resident set size of this process and its children, in bytes,
+    or None where it can't be measured.
+    '''
+    if resource == None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == 'darwin':
+        return peak  # already in bytes
+    return peak * 1024
+
+
+def run_backend(language_name, version, backend, file_paths, jobs, repeat):
+    '''
+    Scan the corpus with one backend, `repeat` times, in a fresh process so
+    that its peak memory is measured on its own.
+    '''
+    setup_start = time.perf_counter()
+    assistant = DriverMigrationAssistant(language_name, 0, version, 'plain', backend == 'regex')
+    setup_seconds = time.perf_counter() - setup_start
+
+    timings = []
+    findings_count = 0
+    for _ in range(repeat):
+        findings_count = 0
+        start = time.perf_counter()
+        for source, findings in assistant.scan_files(file_paths, jobs):
+            findings_count += len(findings)
+        timings.append(time.perf_counter() - start)
+    return setup_seconds, timings, findings_count, peak_memory()
+
+
+def prefilter_mismatches(language_name, version, file_paths):
+    '''
+    Paths of the files whose tree-sitter findings change when the literal
+    prefilter is disabled, i.e. where it skips a pattern that would match.
+    '''
+    assistants = [
+        DriverMigrationAssistant(language_name, 0, version, 'plain', False, prefilter=prefilter)
+        for prefilter in (True, False)
+    ]
+    mismatches = []
+    for file_path in file_paths:
+        filtered, unfiltered = (
+            [(f.change_id, f.line, f.col_start, f.col_end) for f in assistant.process_file(file_path)]
+            for assistant in assistants
+        )
+        if filtered != unfiltered:
+            mismatches.append(file_path)
+    return mismatches
+
+
+def git_revision():
+    try:
+        result = subprocess.run(
+            ['git', '-C', os.path.dirname(os.path.abspath(__file__)), 'rev-parse', 'HEAD'],
+            capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+@click.command(help='Measure the throughput of the migration assistant on a synthetic corpus, '
+                    'generated from the changelog entries of each language, with both the '
+                    'tree-sitter and the regex parser. Results are appended to a JSON file.')
+@click.help_option('--help', '-h')
+@click.option(
+    '--language', '-l', 'language_names', multiple=True,
+    type=click.Choice(list(HIT_TEMPLATES)),
+    help='Language to benchmark. Can be repeated. Default: all of them.'
+)
+@click.option(
+    '--files', 'files_count', default=200, show_default=True, type=click.IntRange(min=1),
+    help='Number of files in each corpus.'
+)
+@click.option(
+    '--file-size', 'file_size', default=8, show_default=True, type=click.IntRange(min=1),
+    help='Approximate size of each file, in KB.'
+)
+@click.option(
+    '--hit-density', 'hit_density', default=0.02, show_default=True, type=click.FloatRange(0, 1),
+    help='Fraction of lines triggering a changelog entry.'
+)
+@click.option(
+    '--version', default='6.0', show_default=True,
+    help='What version of the library to test compatibility against.'
+)
+@click.option(
+    '--jobs', '-j', 'jobs', default=1, show_default=True, type=click.IntRange(min=1),
+    help='Number of processes to scan files with.'
+)
+@click.option(
+    '--repeat', 'repeat', default=3, show_default=True, type=click.IntRange(min=1),
+    help='Number of scans per backend. The fastest one is reported.'
+)
+@click.option(
+    '--seed', 'seed', default=0, show_default=True,
+    help='Seed of the corpus generator, for reproducible corpora.'
+)
+@click.option(
+    '--corpus-dir', 'corpus_dir', default=None, type=click.Path(file_okay=False),
+    help='Generate corpora in this directory and keep them. By default, a temporary directory is used and removed.'
+)
+@click.option(
+    '--check-prefilter', 'check_prefilter', is_flag=True, flag_value=True,
+    help='Also check that the corpus and the example projects get the same findings without the literal prefilter.'
+)
+@click.option(
+    '--output', '-o', 'output_path', default='benchmark-results.json', show_default=True, type=click.Path(dir_okay=False),
+    help='JSON file to append results to.'
+)
+def benchmark(language_names, files_count, file_size, hit_density, version, jobs, repeat, seed, corpus_dir, check_prefilter, output_path):
+    try:
+        parsed_version = Version(version)
+    except ValueError:
+        raise click.BadParameter(f'`{version}` is not a valid PEP 440 version.', param_hint='--version')
+    language_names = language_names or list(HIT_TEMPLATES)
+    keep_corpus = corpus_dir != None
+    if not keep_corpus:
+        corpus_dir = tempfile.mkdtemp(prefix='migration-assistant-benchmark-')
+
+    run = {
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'settings': {
+            'files': files_count, 'file_size_kb': file_size, 'hit_density': hit_density,
+            'version': version, 'jobs': jobs, 'repeat': repeat, 'seed': seed,
+        },
+        'results': [],
+    }
+    mismatches = []
+    try:
+        for language_name in language_names:
+            language_dir = os.path.join(corpus_dir, language_name)
+            os.makedirs(language_dir, exist_ok=True)
+            generator = CorpusGenerator(language_name, parsed_version, file_size * 1024, hit_density, seed)
+            file_paths, total_size = generator.generate(language_dir, files_count)
+
+            for backend in BACKENDS:
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                    setup_seconds, timings, findings_count, peak = executor.submit(
+                        run_backend, language_name, version, backend, file_paths, jobs, repeat).result()
+                seconds = min(timings)
+                result = {
+                    'language': language_name,
+                    'backend': backend,
+                    'files': files_count,
+                    'bytes': total_size,
+                    'findings': findings_count,
+                    'setup_seconds': round(setup_seconds, 4),
+                    'seconds': round(seconds, 4),
+                    'files_per_second': round(files_count / seconds, 2),
+                    'mb_per_second': round(total_size / 1024 / 1024 / seconds, 3),
+                    'findings_per_second': round(findings_count / seconds, 2),
+                    'peak_memory_mb': round(peak / 1024 / 1024, 1) if peak != None else None,
+                }
+                run['results'].append(result)
+                click.echo(
+                    f'{language_name:<11} {backend:<12} {result["files_per_second"]:>9} files/s '
+                    f'{result["mb_per_second"]:>8} MB/s {result["findings_per_second"]:>10} findings/s '
+                    f'{str(result["peak_memory_mb"]):>7} MB peak')
+
+            if check_prefilter:
+                examples = parse_path([os.path.join(EXAMPLES_DIR, language_name)], FileSelector(language_name, (), False))
+                checked = file_paths + list(examples)
+                language_mismatches = prefilter_mismatches(language_name, version, checked)
+                click.echo(f'{language_name:<11} prefilter    {len(checked) - len(language_mismatches)}/{len(checked)} '
+                           f'files with the same findings')
+                mismatches += language_mismatches
+    finally:
+        if not keep_corpus:
+            shutil.rmtree(corpus_dir, ignore_errors=True)
+
+    runs = []
+    if os.path.exists(output_path):
+        with open(output_path) as f:
+            runs = json.load(f)
+    runs.append(run)
+    with open(output_path, 'w') as f:
+        json.dump(runs, f, indent=2)
+    click.echo(f'Results appended to {output_path}')
+    if mismatches != []:
+        click.echo('Findings differ without the prefilter in:\n' + '\n'.join(mismatches), err=True)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    benchmark()
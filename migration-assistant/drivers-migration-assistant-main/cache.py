@@ -0,0 +1,123 @@
+import json
+import os
+import tempfile
+import time
+from glob import glob
+from hashlib import sha256
+from importlib import metadata
+
+
+# Bump when the format of cached findings changes.
+CACHE_VERSION = 1
+# Code that findings depend on, relative to this directory.
+MATCHING_CODE = ('parsers.py', 'prefilter.py', 'rules.py', 'languagequeries/*.py')
+MATCHING_PACKAGES = ('tree-sitter', 'tree-sitter-python', 'tree-sitter-go', 'tree-sitter-javascript')
+# Age after which a temporary file is left over from a killed run, in seconds.
+STALE_TMP_AGE = 3600
+
+
+class ScanCache:
+    '''
+    On-disk cache of raw findings per file, so unchanged files need not be
+    parsed and queried again on the next run.
+
+    Entries are keyed by the file content hash plus everything else the
+    findings depend on (changelog hash, target version, parser mode, the
+    matching code and grammars, see matching_code_digest()), and stored one
+    file per key. Writes are atomic renames and eviction tolerates
+    entries vanishing underneath it, so several runs (or worker processes)
+    may share the same directory.
+    Recency is tracked through entries' mtime, which is bumped on each hit;
+    prune() evicts least recently used entries until the cache fits max_size.
+    '''
+
+    def __init__(self, directory, max_size, *key_parts):
+        self.directory = directory
+        self.max_size = max_size
+        self.key_prefix = '::'.join(str(part) for part in (CACHE_VERSION, matching_code_digest()) + key_parts)
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, content):
+        return sha256(self.key_prefix.encode() + b'::' + sha256(content).digest()).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        path = self.entry_path(key)
+        try:
+            with open(path) as f:
+                findings = json.load(f)
+            os.utime(path)  # mark as recently used
+        except (OSError, ValueError):
+            return None
+        return findings
+
+    def set(self, key, findings):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(findings, f)
+            os.replace(tmp_path, self.entry_path(key))
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def prune(self):
+        '''
+        Evict least recently used entries until the cache fits max_size bytes,
+        and remove temporary files left behind by runs killed while writing.
+        '''
+        entries = []
+        total_size = 0
+        stale_before = time.time() - STALE_TMP_AGE
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(('.json', '.tmp')):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue  # evicted by a concurrent run
+                if entry.name.endswith('.tmp'):
+                    if stat.st_mtime < stale_before:
+                        try:
+                            os.remove(entry.path)
+                        except OSError:
+                            pass
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_size -= size
+
+
+def matching_code_digest():
+    '''
+    Hash of the code and tree-sitter packages that turn a file into findings,
+    so that upgrading either invalidates the cache.
+    '''
+    digest = sha256()
+    base = os.path.dirname(os.path.abspath(__file__))
+    for pattern in MATCHING_CODE:
+        for path in sorted(glob(os.path.join(base, pattern))):
+            digest.update(os.path.relpath(path, base).encode() + b'\0')
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    for package in MATCHING_PACKAGES:
+        try:
+            version = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            version = ''
+        digest.update(f'{package}=={version}'.encode() + b'\0')
+    return digest.hexdigest()
@@ -0,0 +1,36 @@
+class Finding:
+    '''
+    A hit of a changelog rule in a source file.
+
+    Findings are cheap to create, compare and send across processes: they
+    only hold the location of the hit and what the rule says about it.
+    Rendering the message with its context happens at output time, and only
+    for findings that are actually displayed.
+
+    line: 0-based line number.
+    col_start, col_end: character columns of the hit on that line.
+    byte_start, byte_end: the same columns in bytes, as found by the parser.
+    '''
+
+    __slots__ = ('change_id', 'path', 'line', 'col_start', 'col_end', 'byte_start', 'byte_end',
+                 'deprecated', 'removed', 'hash')
+
+    def __init__(self, change_id, path, line, col_start, col_end, byte_start, byte_end, deprecated, removed):
+        self.change_id = change_id
+        self.path = path
+        self.line = line
+        self.col_start = col_start
+        self.col_end = col_end
+        self.byte_start = byte_start
+        self.byte_end = byte_end
+        self.deprecated = deprecated
+        self.removed = removed
+        self.hash = None
+
+    @property
+    def severity(self):
+        return 'removed' if self.removed else 'deprecated'
+
+    def sort_key(self):
+        # by source line number; break ties by starting col number
+        return (self.line, self.col_start)
@@ -3,6 +3,9 @@ from ._common import match_var
 
 class GoQueries:
 
+    # matches the driver's package in import statements
+    import_marker = '\\\\bneo4j\\\\b'
+
     def function(self, name):
         return f"""
             (call_expression
@@ -70,7 +73,7 @@ class GoQueries:
         """
 
     def _import_for_namespace(self):
-        regex = '\\\\bneo4j\\\\b'
+        regex = self.import_marker
         return f"""
             (import_spec
               name: (package_identifier)? @alias
@@ -79,8 +82,8 @@ class GoQueries:
             ) @root
         """
 
-    def _parse_import_alias(self, match, source_lines):
-        line = source_lines[match[1]['root'].range.start_point[0]]
+    def _parse_import_alias(self, match, source):
+        line = source.line(match[1]['root'].range.start_point[0])
         splitted = line.strip()[1:-1].split('/')
         pkg_name = splitted[-1]
         imported_as = splitted[-1]
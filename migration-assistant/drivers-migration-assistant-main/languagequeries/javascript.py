@@ -3,6 +3,9 @@ from ._common import match_var
 
 class JSQueries:
 
+    # matches the driver's package in import statements
+    import_marker = '\\\\bneo4j-driver\\\\b'
+
     def function(self, name):
         return f"""
             (call_expression
@@ -33,7 +36,7 @@ class JSQueries:
         """
 
     def _import_for_namespace(self):
-        regex = '\\\\bneo4j-driver\\\\b'
+        regex = self.import_marker
         return f"""
             (variable_declarator
               name: (identifier) @alias
@@ -46,8 +49,8 @@ class JSQueries:
             )
         """
 
-    def _parse_import_alias(self, match, source_lines):
-        line = source_lines[match[1]['root'].range.start_point[0]]
+    def _parse_import_alias(self, match, source):
+        line = source.line(match[1]['root'].range.start_point[0])
         splitted = line.strip().split(' ')
         pkg_name = 'neo4j'  # no sub-packages in js
         imported_as = splitted[1]
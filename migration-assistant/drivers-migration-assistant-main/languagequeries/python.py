@@ -3,6 +3,9 @@ from ._common import match_var
 
 class PythonQueries:
 
+    # matches the driver's package in import statements
+    import_marker = '\\\\bneo4j\\\\b'
+
     def function(self, name):
         return f"""
             (call
@@ -128,7 +131,7 @@ class PythonQueries:
         """
 
     def _import_for_namespace(self):
-        regex = '\\\\bneo4j\\\\b'
+        regex = self.import_marker
         return f"""
             (import_statement
               name: (aliased_import
@@ -139,8 +142,8 @@ class PythonQueries:
             ) @root
         """
 
-    def _parse_import_alias(self, match, source_lines):
-        line = source_lines[match[1]['root'].range.start_point[0]]
+    def _parse_import_alias(self, match, source):
+        line = source.line(match[1]['root'].range.start_point[0])
         splitted = line.strip().split(' ')
         pkg_name = splitted[1]
         imported_as = splitted[-1]
@@ -1,8 +1,13 @@
 import click
+import os
+import sys
 from sys import exit
+from time import perf_counter
 
 from assistant import DriverMigrationAssistant
-from utils import Color as color, parse_path
+from selection import FileSelector
+from writers import WRITERS
+from utils import Color as color, parse_path, parse_path_since
 
 
 intro = '''
@@ -18,7 +23,8 @@ Points of care:
 '''
 
 
-@click.command(help=intro + '\nPATH is the location of project to migrate. Supports globbing.')
+@click.command(help=intro + '\nPATH is the location of project to migrate. Supports globbing. '
+                   'Only files with extensions of the chosen language are scanned in directories.')
 @click.help_option('--help', '-h')
 @click.argument('path', nargs=-1)
 @click.option(
@@ -40,12 +46,91 @@ Points of care:
 )
 @click.option(
     '--no-output-colors', 'no_output_colors', is_flag=True, flag_value=True,
-    help="Don't enrich output with colors."
+    help="Don't enrich output with colors (same as --color never)."
+)
+@click.option(
+    '--color', 'color_mode', default='auto', show_default=True,
+    type=click.Choice(['auto', 'always', 'never']),
+    help='Whether to color text output with ANSI codes. auto colors it only when printing to a terminal.'
 )
 @click.option(
     '--regex-parser', '-R', 'regex_parser', is_flag=True, flag_value=True,
     help='Use the regex parser (likely to surface more matches, although with a higher rate of false positives).'
 )
+@click.option(
+    '--single-pass', 'single_pass', is_flag=True, flag_value=True,
+    help='Run all changelog patterns as one tree-sitter query, traversing each file once (ignored with --regex-parser).'
+)
+@click.option(
+    '--jobs', '-j', 'jobs', default=1, show_default=True, type=click.IntRange(min=0),
+    help='Number of processes to scan files with (0 for one per CPU). Output order is unaffected.'
+)
+@click.option(
+    '--since', 'since', default=None, metavar='REF',
+    help='Only scan files added or changed relative to this git ref (e.g. origin/main), according to the local repository.'
+)
+@click.option(
+    '--exclude', '-e', 'excludes', multiple=True, metavar='PATTERN',
+    help='Skip files and directories matching this pattern (.gitignore syntax). Can be repeated.'
+)
+@click.option(
+    '--no-gitignore', 'no_gitignore', is_flag=True, flag_value=True,
+    help="Don't skip files ignored by the project's .gitignore files when walking directories."
+)
+@click.option(
+    '--max-file-size', 'max_file_size', default=10240, show_default=True, type=click.IntRange(min=0),
+    help='Skip files larger than this, in KB (0 for no limit). Binary and minified files are always skipped.'
+)
+@click.option(
+    '--regex-fallback', 'regex_fallback', is_flag=True, flag_value=True,
+    help='Scan oversized and minified files with the regex parser instead of skipping them.'
+)
+@click.option(
+    '--driver-files-only', 'driver_files_only', is_flag=True, flag_value=True,
+    help="Don't parse files that don't import the driver. Faster on large codebases, "
+         "but misses hits in files using driver objects imported elsewhere."
+)
+@click.option(
+    '--cache-dir', 'cache_dir', default=None, type=click.Path(file_okay=False),
+    help='Cache findings for each file content in this directory, and skip unchanged files on later runs.'
+)
+@click.option(
+    '--cache-max-size', 'cache_max_size', default=100, show_default=True, type=click.IntRange(min=1),
+    help='Maximum size of the cache directory, in MB. Least recently used entries are evicted first.'
+)
+@click.option(
+    '--format', 'output_format', default='text', show_default=True,
+    type=click.Choice(['text', 'html', 'jsonl', 'sarif']),
+    help='Output format. html is the text report as a standalone page. html, jsonl and sarif are written to stdout '
+         'one file at a time, imply --no-interactive, and send the opening warning to stderr.'
+)
+@click.option(
+    '--group', 'group_hits', is_flag=True, flag_value=True,
+    help='Show hits whose context lines overlap as a single block of source, like grep -C. '
+         'In interactive mode, ignoring a block ignores all hits in it.'
+)
+@click.option(
+    '--profile', 'profile', is_flag=True, flag_value=True,
+    help='Time each phase of the run and each changelog pattern, and print a report to stderr at the end.'
+)
+@click.option(
+    '--profile-output', 'profile_output', default=None, type=click.Path(dir_okay=False),
+    help='Write the --profile report to this file as JSON instead (implies --profile).'
+)
+@click.option(
+    '--slowest', 'slowest', default=0, type=click.IntRange(min=0), metavar='N',
+    help='Print the N files that took longest to scan, with their size and hit count, to stderr at the end.'
+)
+@click.option(
+    '--slow-profile-dir', 'slow_profile_dir', default=None, type=click.Path(file_okay=False),
+    help='Scan the slowest files again under cProfile, and write a .prof dump for each into this directory '
+         '(implies --slowest 5, unless given).'
+)
+@click.option(
+    '--trace-memory', 'trace_memory', is_flag=True, flag_value=True,
+    help='Measure peak memory per phase (file load, tree-sitter tree, captures, rendering) and per file, '
+         'and print a report to stderr at the end. Implies --jobs 1, and slows the run down.'
+)
 @click.option(
     '--no-interactive', 'no_interactive', is_flag=True, flag_value=True,
     help='Run the tool without pause after each entry.'
@@ -54,66 +139,207 @@ Points of care:
     '--show-ignored', 'show_ignored', is_flag=True, flag_value=True,
     help='Include ignored entries in output.'
 )
-def assist(path, language_name, context_lines, version, accept_warning, no_output_colors, regex_parser, no_interactive, show_ignored):
-    assistant = DriverMigrationAssistant(language_name, context_lines, version, no_output_colors, regex_parser)
-    warn_user(accept_warning, language_name)
-    file_paths = parse_path(path)
-    assistant.print_msg('-'*50)
-    assistant.print_msg('\n' + click.style('Files to process: ', bold=True) + str(len(file_paths)) + '\n')
+def assist(path, language_name, context_lines, version, accept_warning, no_output_colors, color_mode, regex_parser, single_pass, jobs, since, excludes, no_gitignore, max_file_size, regex_fallback, driver_files_only, cache_dir, cache_max_size, output_format, group_hits, profile, profile_output, slowest, slow_profile_dir, trace_memory, no_interactive, show_ignored):
+    if output_format == 'html':
+        output_style = 'html'
+    elif no_output_colors or color_mode == 'never':
+        output_style = 'plain'
+    elif color_mode == 'always':
+        output_style = 'ansi'
+    else:
+        output_style = 'auto'
+    assistant = DriverMigrationAssistant(language_name, context_lines, version, output_style, regex_parser, single_pass,
+                                         cache_dir, cache_max_size * 1024 * 1024, max_file_size * 1024, regex_fallback,
+                                         profile or profile_output != None,
+                                         slowest or (5 if slow_profile_dir != None else 0), trace_memory,
+                                         driver_files_only)
+    machine_output = output_format in WRITERS
+    warn_user(accept_warning, language_name, err=output_format != 'text')
+    wall_start = perf_counter()
+    if output_format == 'html':
+        no_interactive = True
+    selector = FileSelector(language_name, excludes, not no_gitignore)
+    if since != None:
+        file_paths = parse_path_since(path, since, selector)
+    else:
+        file_paths = parse_path(path, selector)
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    if trace_memory:
+        jobs = 1
+
+    if machine_output:
+        write_findings(assistant, WRITERS[output_format](sys.stdout, assistant.rules),
+                       assistant.scan_files(file_paths, jobs), show_ignored)
+        report_profile(assistant, profile_output, wall_start)
+        report_slow_files(assistant, slow_profile_dir)
+        report_memory(assistant)
+        return
+
+    r = assistant.renderer
+    assistant.output.write(r.header)
     assistant.print_msg('-'*50 + '\n')
 
-    deprecated_count = 0; removed_count = 0;
-    for file_path in file_paths:
-        assistant.print_msg(click.style(f'File: {file_path}\n', fg=color.file, bold=True))
-        messages = assistant.process_file(file_path)
-        for i in range(len(messages)):
-            msg = messages[i]
-
-            if not show_ignored and assistant.is_ignored_msg(msg):
-                assistant.print_msg(click.style(
-                    f'({i+1}/{len(messages)}) ' + 'Ignored\n',
-                    fg='blue', bold=True))
-                continue
-
-            assistant.print_msg(click.style(
-                f'({i+1}/{len(messages)}) {msg["content"]}',
-                fg='blue', bold=True))
-
-            if not no_interactive:
-                choice = click.prompt(
-                    click.style(
-                        'What to do? [(n) Next, (i) Add to ignore list and hide]',
-                        fg='blue', bold=True
-                    ), type=click.Choice(['n', 'i']), show_choices=False)
-                if choice == 'i':
-                    assistant.set_ignore_msg(msg)
-                assistant.print_msg('')  # newline
+    deprecated_count = 0; removed_count = 0; files_count = 0;
+    skipped = []
+    irrelevant_count = 0
+    for source, findings in assistant.scan_files(file_paths, jobs):
+        files_count += 1
+        if not source.relevant:
+            irrelevant_count += 1
+        assistant.print_msg(r.style(f'File: {source.path}\n', fg=color.file, bold=True))
+        if source.skipped != None:
+            skipped.append(source)
+            assistant.print_msg(r.style(f'Skipped ({source.skipped})\n', fg='blue', bold=True))
+        elif source.downgraded != None:
+            assistant.print_msg(r.style(f'Scanned with the regex parser ({source.downgraded})\n', fg='blue', bold=True))
+        if group_hits:
+            show_grouped(assistant, source, findings, show_ignored, no_interactive)
+        else:
+            for i in range(len(findings)):
+                finding = findings[i]
+
+                if not show_ignored and assistant.is_ignored_msg(finding):
+                    assistant.uncount_msg(finding)
+                    assistant.print_msg(r.style(f'({i+1}/{len(findings)}) Ignored\n', fg='blue', bold=True))
+                    continue
+
+                assistant.print_msg(
+                    r.style(f'({i+1}/{len(findings)}) ', fg='blue', bold=True) +
+                    assistant.render_finding(finding, source))
 
+                if not no_interactive:
+                    prompt_ignore(assistant, [finding])
+
+        assistant.ignored.flush()
         deprecated_count += assistant.source.deprecated_count
         removed_count += assistant.source.removed_count
 
         assistant.print_msg(
-            click.style('\nDeprecations in file: ', bold=True) +
-            click.style(assistant.source.deprecated_count, fg=color.deprecated))
+            r.style('\nDeprecations in file: ', bold=True) +
+            r.style(assistant.source.deprecated_count, fg=color.deprecated))
         assistant.print_msg(
-            click.style('Removals in file: ', bold=True) +
-            click.style(assistant.source.removed_count, fg=color.removed) + '\n')
+            r.style('Removals in file: ', bold=True) +
+            r.style(assistant.source.removed_count, fg=color.removed) + '\n')
 
         assistant.print_msg('-'*50)
+        assistant.output.flush()
+
+    if assistant.cache != None:
+        assistant.cache.prune()
+
+    assistant.print_msg(r.style('\nFiles processed: ', bold=True) + str(files_count))
+    if irrelevant_count > 0:
+        assistant.print_msg(r.style('Files with no changelog identifiers (not parsed): ', bold=True) + str(irrelevant_count))
+    assistant.print_msg(r.style('Total deprecations: ', bold=True) + r.style(deprecated_count, fg=color.deprecated))
+    assistant.print_msg(r.style('Total removals: ', bold=True) + r.style(removed_count, fg=color.removed))
+    if skipped != []:
+        assistant.print_msg(r.style('Files skipped: ', bold=True) + str(len(skipped)))
+        for source in skipped:
+            assistant.print_msg(r.escape(f'  {source.path} ({source.skipped})'))
+
+    assistant.print_msg(r.style('\nLibrary full manual: ', bold=True) + f'https://neo4j.com/docs/{language_name}-manual/current/')
+    assistant.print_msg(r.style('Migration guide: ', bold=True) + f'https://neo4j.com/docs/{language_name}-manual/current/migration/' + '\n')
+    assistant.output.write(r.footer)
+    assistant.output.flush()
+    report_profile(assistant, profile_output, wall_start)
+    report_slow_files(assistant, slow_profile_dir)
+    report_memory(assistant)
+
+
+def show_grouped(assistant, source, findings, show_ignored, no_interactive):
+    '''
+    Show findings whose context windows overlap as one block of source,
+    rather than repeating the same lines for each of them.
+    '''
+    r = assistant.renderer
+    shown = []
+    ignored_count = 0
+    for finding in findings:
+        if not show_ignored and assistant.is_ignored_msg(finding):
+            assistant.uncount_msg(finding)
+            ignored_count += 1
+        else:
+            shown.append(finding)
+    if ignored_count > 0:
+        assistant.print_msg(r.style(f'Ignored: {ignored_count}\n', fg='blue', bold=True))
+
+    i = 0
+    for group in assistant.group_findings(shown):
+        if len(group) == 1:
+            position = f'({i+1}/{len(shown)}) '
+            output = assistant.render_finding(group[0], source)
+        else:
+            position = f'({i+1}-{i+len(group)}/{len(shown)}) '
+            output = assistant.render_group(group, source)
+        assistant.print_msg(r.style(position, fg='blue', bold=True) + output)
+        i += len(group)
+
+        if not no_interactive:
+            prompt_ignore(assistant, group)
+
+
+def prompt_ignore(assistant, findings):
+    r = assistant.renderer
+    assistant.output.flush()
+    choice = click.prompt(
+        r.style(
+            'What to do? [(n) Next, (i) Add to ignore list and hide]',
+            fg='blue', bold=True
+        ), type=click.Choice(['n', 'i']), show_choices=False)
+    if choice == 'i':
+        for finding in findings:
+            assistant.set_ignore_msg(finding)
+    assistant.print_msg('')  # newline
+
+
+def write_findings(assistant, writer, scanned_files, show_ignored):
+    '''
+    Stream findings in a machine readable format, without styling them.
+    '''
+    for source, findings in scanned_files:
+        if not show_ignored:
+            findings = [finding for finding in findings if not assistant.is_ignored_msg(finding)]
+        start = perf_counter()
+        writer.write_file(source, findings)
+        if assistant.profiler != None:
+            assistant.profiler.add('output', start)
+    writer.close()
+
+    if assistant.cache != None:
+        assistant.cache.prune()
+
+
+def report_profile(assistant, profile_output, wall_start):
+    if assistant.profiler == None:
+        return
+    wall_seconds = perf_counter() - wall_start
+    if profile_output != None:
+        assistant.profiler.write_json(profile_output, wall_seconds)
+    else:
+        click.echo(assistant.profiler.format_report(wall_seconds), err=True)
+
+
+def report_slow_files(assistant, slow_profile_dir):
+    if assistant.slow_files == None:
+        return
+    click.echo(assistant.slow_files.format_report(), err=True)
+    if slow_profile_dir != None:
+        for dump_path in assistant.slow_files.dump_profiles(assistant, slow_profile_dir):
+            click.echo(f'Profile written to {dump_path}', err=True)
 
-    assistant.print_msg(click.style('\nTotal deprecations: ', bold=True) + click.style(deprecated_count, fg=color.deprecated))
-    assistant.print_msg(click.style('Total removals: ', bold=True) + click.style(removed_count, fg=color.removed))
 
-    assistant.print_msg(click.style('\nLibrary full manual: ', bold=True) + f'https://neo4j.com/docs/{language_name}-manual/current/')
-    assistant.print_msg(click.style('Migration guide: ', bold=True) + f'https://neo4j.com/docs/{language_name}-manual/current/migration/' + '\n')
+def report_memory(assistant):
+    if assistant.memory_tracer != None:
+        click.echo(assistant.memory_tracer.format_report(), err=True)
 
 
-def warn_user(accept_warning, language_name):
+def warn_user(accept_warning, language_name, err=False):
     if not accept_warning:
-        print(welcome_warning.format(language_name=language_name))
-        agree = click.confirm('Have you carefully read this info?')
+        click.echo(welcome_warning.format(language_name=language_name), err=err)
+        agree = click.confirm('Have you carefully read this info?', err=err)
         if not agree:
-            print("You don't YOLO much, do you?")
+            click.echo("You don't YOLO much, do you?", err=err)
             exit()
 
 
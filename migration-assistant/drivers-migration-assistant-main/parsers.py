@@ -1,6 +1,9 @@
 import re
+from time import perf_counter
 from tree_sitter import Language, Parser
 
+from prefilter import required_literals
+
 
 '''
 Backslashes in ts_patterns should be escaped twice.
@@ -35,6 +38,9 @@ def format_pattern_string(pattern_s, change, namespaces):
 
 class TreeSitterParser:
 
+    # whether set_source() runs all patterns, rather than get_captures_for_pattern() each
+    matches_all_patterns = False
+
     def __init__(self, language_name):
         if language_name == 'python':
             import tree_sitter_python as tslang
@@ -45,7 +51,6 @@ class TreeSitterParser:
             from languagequeries.go import GoQueries
             self.queries = GoQueries()
         elif language_name == 'javascript':
-            print("Importing javascript tree-sitter")
             import tree_sitter_javascript as tslang
             from languagequeries.javascript import JSQueries
             self.queries = JSQueries()
@@ -53,33 +58,87 @@ class TreeSitterParser:
             # click should prevent ever getting here
             raise ValueError('Invalid language. Valid choices are: python, go, javascript.')
 
-        print(tslang.language())
-        self.language = Language(tslang.language(), 'javascript')
+        self.language = Language(tslang.language())
+        # strings any file importing the driver contains
+        self.import_markers = [
+            literal.encode('utf8')
+            for literal in required_literals(self.queries.import_marker.replace('\\\\', '\\'))
+        ]
+
+        # Compiled queries, keyed by ts_type and namespace-formatted patterns.
+        # Shared across files: the same query is only rebuilt when a file
+        # aliases a namespace differently.
+        self.query_cache = {}
+        self.query_cache_hits = 0
+        self.query_cache_misses = 0
+        # set by the assistant when profiling
+        self.profiler = None
+        # whether to skip looking for namespace imports in files without an import marker
+        self.prefilter = True
 
     def set_source(self, source):
         self.source = source
-        self.ast = Parser(self.language).parse(bytes(self.source.text, 'utf8'))
-        self.namespaces = self.build_namespaces_dict()
+        if self.profiler != None:
+            start = perf_counter()
+        self.ast = Parser(self.language).parse(self.source.data)
+        if self.profiler != None:
+            start = self.profiler.add('parse', start)
+        self.namespaces = {}
+        if not self.prefilter or self.imports_driver(self.source):  # otherwise nothing can be aliased
+            self.namespaces = self.build_namespaces_dict()
+        if self.profiler != None:
+            self.profiler.add('namespaces', start)
+
+    def imports_driver(self, source):
+        return any(source.contains(marker) for marker in self.import_markers)
 
     def get_captures_for_pattern(self, pattern, change):
         if pattern.get('ts_pattern') == None:
             return []
 
+        pattern_formatted = self.format_patterns(pattern, change, self.namespaces)
+        matches = self.get_query(pattern['ts_type'], pattern_formatted)
+        if pattern.get('ts_uniqueify') != None and pattern.get('ts_uniqueify') == 'True':
+            captures = self.uniqueify_captures(matches.captures(self.ast.root_node), pattern)
+        else:
+            captures = matches.captures(self.ast.root_node)
+        return [(c[0].range.start_point, c[0].range.end_point) for c in captures]  # only extract relevant bits
+
+    def format_patterns(self, pattern, change, namespaces):
         if isinstance(pattern['ts_pattern'], str):
-            pattern_formatted = format_pattern_string(pattern['ts_pattern'], change, self.namespaces)
-            query = getattr(self.queries, pattern['ts_type'])(pattern_formatted)
+            return (format_pattern_string(pattern['ts_pattern'], change, namespaces), )
         elif isinstance(pattern['ts_pattern'], list):
-            pattern_formatted = [format_pattern_string(p, change, self.namespaces) for p in pattern['ts_pattern']]
-            query = getattr(self.queries, pattern['ts_type'])(*pattern_formatted)
+            return tuple(format_pattern_string(p, change, namespaces) for p in pattern['ts_pattern'])
         else:
             raise ValueError('Change identifier must be str or list.')
 
-        matches = self.language.query(query)
-        if pattern.get('ts_uniqueify') != None and pattern.get('ts_uniqueify') == 'True':
-            captures = self.uniqueify_captures(matches.captures(self.ast.root_node), pattern)
+    def get_query(self, ts_type, pattern_formatted):
+        '''
+        Return the compiled query for a pattern, compiling it on first use.
+
+        ts_type: name of the query builder in languagequeries.
+        pattern_formatted: tuple of patterns, with namespaces substituted.
+        '''
+        key = (ts_type, pattern_formatted)
+        query = self.query_cache.get(key)
+        self.count_query_cache(query != None)
+        if query != None:
+            return query
+
+        query = self.language.query(getattr(self.queries, ts_type)(*pattern_formatted))
+        self.query_cache[key] = query
+        return query
+
+    def count_query_cache(self, hit):
+        '''
+        Count a query cache lookup, in the --profile report if profiling.
+        '''
+        if hit:
+            self.query_cache_hits += 1
         else:
-            captures = matches.captures(self.ast.root_node)
-        return [(c[0].range.start_point, c[0].range.end_point) for c in captures]  # only extract relevant bits
+            self.query_cache_misses += 1
+        if self.profiler != None:
+            self.profiler.count('query cache hits' if hit else 'query cache misses')
 
     def uniqueify_captures(self, captures, pattern):
         '''
@@ -105,35 +164,148 @@ class TreeSitterParser:
         the user's codebase so that the defaults may be overwritten.
         Dict has form {default_name : alias}.
         """
+        matches = self.get_query('_import_for_namespace', ()).matches(self.ast.root_node)
+        return self.namespaces_from_matches(matches)
+
+    def namespaces_from_matches(self, matches):
         namespaces_d = {}
-        ast = self.ast
-        query = self.queries._import_for_namespace()
-        matches = self.language.query(query).matches(ast.root_node)
         for m in matches:
             if m[1] == {}:
                 continue
-            pkg_name, imported_as = self.queries._parse_import_alias(m, self.source.lines)
+            pkg_name, imported_as = self.queries._parse_import_alias(m, self.source)
             namespaces_d[pkg_name] = imported_as
         return namespaces_d
 
+
+class SinglePassTreeSitterParser(TreeSitterParser):
+    '''
+    Runs all the changelog patterns as a single multi-pattern query, so that
+    each file's tree is traversed once regardless of changelog size.
+    Results are dispatched back to each pattern by pattern index, and served
+    through the same interface as TreeSitterParser.
+
+    Each query builder in languagequeries must yield exactly one pattern.
+    '''
+
+    matches_all_patterns = True
+
+    def __init__(self, language_name, rules):
+        super().__init__(language_name)
+        self.rules = rules
+        # (pattern, change) for every ts pattern; list index + 1 is the pattern
+        # index in the combined query, as index 0 is the namespace import query
+        self.ts_patterns = [
+            (pattern, rule.change)
+            for rule in rules for pattern in rule.patterns
+            if pattern.get('ts_pattern') != None
+        ]
+        # default namespace names that some pattern depends on
+        self.rule_namespaces = set(
+            change['namespace'] for _, change in self.ts_patterns
+            if change.get('namespace') != None
+        )
+
+    def set_source(self, source):
+        self.source = source
+        if self.profiler != None:
+            start = perf_counter()
+        self.ast = Parser(self.language).parse(self.source.data)
+        if self.profiler != None:
+            start = self.profiler.add('parse', start)
+
+        matches = self.get_combined_query({}).matches(self.ast.root_node)
+        self.namespaces = self.namespaces_from_matches(m for m in matches if m[0] == 0)
+        aliases = self.effective_aliases(self.namespaces)
+        if aliases != {}:
+            # only files aliasing a namespace the changelog relies on need a second pass
+            matches = self.get_combined_query(aliases).matches(self.ast.root_node)
+
+        self.captures = {}
+        for pattern_index, captures_d in matches:
+            if pattern_index == 0 or captures_d == {}:
+                continue
+            pattern, _ = self.ts_patterns[pattern_index-1]
+            nodes = sorted(captures_d.values(), key=lambda node: node.start_byte)
+            if pattern.get('ts_uniqueify') == 'True':
+                nodes = nodes[-1:]  # same as uniqueify_captures, per match
+            self.captures.setdefault(id(pattern), []).extend(
+                (node.range.start_point, node.range.end_point) for node in nodes)
+        if self.profiler != None:
+            self.profiler.add('queries', start)
+
+    def get_captures_for_pattern(self, pattern, change):
+        return self.captures.get(id(pattern), [])
+
+    def effective_aliases(self, namespaces):
+        return {
+            pkg_name: imported_as for pkg_name, imported_as in namespaces.items()
+            if pkg_name != imported_as and pkg_name in self.rule_namespaces
+        }
+
+    def get_combined_query(self, aliases):
+        key = ('_combined', tuple(sorted(aliases.items())))
+        query = self.query_cache.get(key)
+        self.count_query_cache(query != None)
+        if query != None:
+            return query
+
+        query_s = self.queries._import_for_namespace()
+        for pattern, change in self.ts_patterns:
+            pattern_formatted = self.format_patterns(pattern, change, aliases)
+            query_s += getattr(self.queries, pattern['ts_type'])(*pattern_formatted)
+        query = self.language.query(query_s)
+        self.query_cache[key] = query
+        return query
+
 class RegexParser:
+    '''
+    Matches re_patterns against the raw source bytes.
+
+    All the patterns are compiled once into a single regex, made of
+    one optional lookahead per pattern, so that each file's text is scanned
+    in a single finditer pass and overlapping hits of different patterns are
+    all surfaced. Hits are reported per pattern, as with re.finditer, and
+    never span multiple lines.
+    '''
+
+    matches_all_patterns = True
+
+    def __init__(self, rules):
+        self.re_patterns = []
+        for rule in rules:
+            for pattern in rule.patterns:
+                if pattern.get('re_pattern') != None:
+                    self.re_patterns.append(
+                        (pattern, format_pattern_string(pattern['re_pattern'], rule.change, {})))
+
+        any_pattern = '|'.join(f'(?:{re_pattern})' for _, re_pattern in self.re_patterns)
+        each_pattern = ''.join(
+            f'(?:(?=(?P<p{i}>{re_pattern})))?' for i, (_, re_pattern) in enumerate(self.re_patterns))
+        self.regex = re.compile(f'(?={any_pattern}){each_pattern}'.encode('utf8'), re.MULTILINE)
+        self.group_names = [f'p{i}' for i in range(len(self.re_patterns))]
+        # set by the assistant when profiling
+        self.profiler = None
 
     def set_source(self, source):
         self.source = source
+        data = self.source.data
+        if self.profiler != None:
+            profile_start = perf_counter()
+
+        self.captures = {}
+        last_ends = {}
+        for match in self.regex.finditer(data):
+            for group_name in self.group_names:
+                start, end = match.span(group_name)
+                if start == -1 or start < last_ends.get(group_name, 0) or data.find(b'\n', start, end) != -1:
+                    continue
+                last_ends[group_name] = end
+                line_n, col = self.source.point(start)
+                pattern, _ = self.re_patterns[int(group_name[1:])]
+                self.captures.setdefault(id(pattern), []).append(
+                    ((line_n, col), (line_n, col + end - start)))
+        if self.profiler != None:
+            self.profiler.add('queries', profile_start)
 
     def get_captures_for_pattern(self, pattern, change):
-        captures = []
-
-        if pattern.get('re_pattern') == None:
-            return captures
-
-        for i in range(len(self.source.lines)):
-            match = re.search(pattern['re_pattern'], self.source.lines[i])
-            if match != None:
-                captures.append(
-                    (
-                        (i, match.start()),
-                        (i, match.end())
-                    )
-                )
-        return captures
+        return self.captures.get(id(pattern), [])
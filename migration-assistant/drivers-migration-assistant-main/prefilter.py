@@ -0,0 +1,104 @@
+import re
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse, sre_constants
+
+
+def required_literals(regex):
+    '''
+    A set of strings one of which occurs in any text `regex` matches, or None
+    if no such set can be told from the regex.
+    '''
+    try:
+        tokens = sre_parse.parse(regex)
+    except re.error:
+        return None
+    return _required(tokens)
+
+
+def _required(tokens):
+    constants = sre_constants
+    candidates = []
+    run = ''
+    for op, arg in tokens:
+        if op == constants.LITERAL:
+            run += chr(arg)
+            continue
+        if run != '':
+            candidates.append({run})
+            run = ''
+        if op == constants.SUBPATTERN:
+            candidates.append(_required(arg[-1]))
+        elif op == constants.BRANCH:
+            branches = [_required(branch) for branch in arg[1]]
+            if all(branch != None for branch in branches):
+                candidates.append(set().union(*branches))
+        elif op in (constants.MAX_REPEAT, constants.MIN_REPEAT) and arg[0] > 0:
+            candidates.append(_required(arg[2]))
+        # anything else matches text that can't be known in advance
+    if run != '':
+        candidates.append({run})
+
+    # the most selective set is the one whose shortest string is the longest
+    best = None
+    for candidate in candidates:
+        if candidate == None or '' in candidate:
+            continue
+        if best == None or min(map(len, candidate)) > min(map(len, best)):
+            best = candidate
+    return best
+
+
+def pattern_literals(regexes):
+    '''
+    Literal requirements of a changelog pattern, given its regexes after
+    namespace formatting: a tuple of sets of bytes, one per regex that has
+    any, such that a file can only hold a hit if, for every set, some string
+    of it occurs in the file. Negated (`?!`) regexes require nothing.
+    '''
+    clauses = []
+    for regex in regexes:
+        if regex.startswith('?!'):
+            continue
+        literals = required_literals(regex)
+        if literals != None:
+            clauses.append(frozenset(literal.encode('utf8') for literal in literals))
+    return tuple(clauses)
+
+
+class LiteralMatcher:
+    '''
+    Finds which of a set of literals occur in a text, in a single pass.
+
+    All the literals are compiled into one regex alternation, longest first,
+    inside a lookahead, so that the longest literal starting at each
+    position is found without consuming text. Shorter literals found inside
+    it, e.g. `Config` inside `SessionConfig`, are added from a table built
+    up front, so every occurrence of every literal is accounted for.
+    '''
+
+    def __init__(self, literals):
+        literals = sorted(set(literals), key=lambda literal: (-len(literal), literal))
+        self.regex = None
+        if literals != []:
+            self.regex = re.compile(b'(?=(' + b'|'.join(re.escape(literal) for literal in literals) + b'))')
+        self.implied = {
+            literal: frozenset(other for other in literals if other in literal)
+            for literal in literals
+        }
+
+    def find(self, data):
+        found = set()
+        if self.regex == None:
+            return found
+        for longest in set(match.group(1) for match in self.regex.finditer(data)):
+            found |= self.implied[longest]
+        return found
+
+
+def clauses_satisfied(clauses, found):
+    for clause in clauses:
+        if clause.isdisjoint(found):
+            return False
+    return True
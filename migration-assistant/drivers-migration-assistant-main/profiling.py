@@ -0,0 +1,312 @@
+import cProfile
+import heapq
+import json
+import os
+import re
+import sys
+import tracemalloc
+from time import perf_counter
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# Report order of phases; phases run in the read-ahead thread overlap the others.
+PHASES = (
+    'walk', 'read', 'sniff', 'cache', 'parse', 'namespaces', 'prefilter', 'queries',
+    'findings', 'ignore', 'render', 'output',
+)
+TOP_PATTERNS = 10
+MEMORY_PHASES = ('load', 'tree', 'captures', 'render')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+class Profiler:
+    '''
+    Accumulates wall time per phase of a run, and per changelog pattern.
+
+    Timed code reads perf_counter() itself and hands the start time to add(),
+    which returns the current time so consecutive phases can be chained.
+    Cache hits and misses are counted with count().
+    Nothing is timed where the profiler is None, so that a run without
+    --profile only pays for a few comparisons.
+    '''
+
+    def __init__(self):
+        self.phases = {}  # phase -> [seconds, calls]
+        self.patterns = {}  # (identifier, pattern index, ts_type) -> [seconds, calls]
+        self.files = 0
+        self.counters = {}  # name -> count
+
+    def add(self, phase, start):
+        now = perf_counter()
+        entry = self.phases.setdefault(phase, [0.0, 0])
+        entry[0] += now - start
+        entry[1] += 1
+        return now
+
+    def add_pattern(self, identifier, index, ts_type, start):
+        now = perf_counter()
+        entry = self.patterns.setdefault((identifier, index, ts_type), [0.0, 0])
+        entry[0] += now - start
+        entry[1] += 1
+        return now
+
+    def count(self, name):
+        self.counters[name] = self.counters.get(name, 0) + 1
+
+    def timed_iter(self, phase, iterable):
+        '''
+        Iterate over `iterable`, timing how long each item takes to produce.
+        '''
+        iterator = iter(iterable)
+        while True:
+            start = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(phase, start)
+                return
+            self.add(phase, start)
+            yield item
+
+    def drain(self):
+        '''
+        Return what was recorded since the last drain, and reset, so that
+        worker processes can hand over their timings file by file.
+        '''
+        state = (self.phases, self.patterns, self.files, self.counters)
+        self.phases = {}
+        self.patterns = {}
+        self.files = 0
+        self.counters = {}
+        return state
+
+    def merge(self, state):
+        phases, patterns, files, counters = state
+        for own, other in ((self.phases, phases), (self.patterns, patterns)):
+            for key, (seconds, calls) in other.items():
+                entry = own.setdefault(key, [0.0, 0])
+                entry[0] += seconds
+                entry[1] += calls
+        self.files += files
+        for name, count in counters.items():
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def report(self, wall_seconds):
+        files = max(self.files, 1)
+        phases = sorted(self.phases.items(), key=lambda item: PHASES.index(item[0]) if item[0] in PHASES else len(PHASES))
+        identifiers = {}
+        for (identifier, _, _), (seconds, calls) in self.patterns.items():
+            entry = identifiers.setdefault(identifier, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += calls
+        top_patterns = sorted(self.patterns.items(), key=lambda item: -item[1][0])[:TOP_PATTERNS]
+
+        return {
+            'wall_seconds': round(wall_seconds, 6),
+            'files': self.files,
+            'phases': [
+                {
+                    'phase': phase,
+                    'seconds': round(seconds, 6),
+                    'calls': calls,
+                    'seconds_per_file': round(seconds / files, 6),
+                } for phase, (seconds, calls) in phases
+            ],
+            'identifiers': [
+                {
+                    'identifier': identifier,
+                    'seconds': round(seconds, 6),
+                    'seconds_per_file': round(seconds / files, 6),
+                } for identifier, (seconds, calls) in sorted(identifiers.items(), key=lambda item: -item[1][0])
+            ],
+            'top_patterns': [
+                {
+                    'identifier': identifier,
+                    'pattern': index,
+                    'ts_type': ts_type,
+                    'seconds': round(seconds, 6),
+                    'calls': calls,
+                } for (identifier, index, ts_type), (seconds, calls) in top_patterns
+            ],
+            'counters': dict(sorted(self.counters.items())),
+        }
+
+    def write_json(self, path, wall_seconds):
+        with open(path, 'w') as f:
+            json.dump(self.report(wall_seconds), f, indent=2)
+
+    def format_report(self, wall_seconds):
+        report = self.report(wall_seconds)
+        lines = [f'Profile: {report["files"]} files in {report["wall_seconds"]:.3f}s', '']
+        lines.append(f'{"phase":<12} {"total (s)":>10} {"calls":>8} {"per file (ms)":>14}')
+        for entry in report['phases']:
+            lines.append(f'{entry["phase"]:<12} {entry["seconds"]:>10.3f} {entry["calls"]:>8} '
+                         f'{entry["seconds_per_file"] * 1000:>14.3f}')
+        if report['top_patterns'] != []:
+            lines.append('')
+            lines.append(f'Slowest changelog patterns (of {len(self.patterns)}):')
+            lines.append(f'{"identifier":<40} {"pattern":>7} {"ts_type":<36} {"total (s)":>10}')
+            for entry in report['top_patterns']:
+                lines.append(f'{entry["identifier"]:<40} {entry["pattern"]:>7} {entry["ts_type"]:<36} '
+                             f'{entry["seconds"]:>10.3f}')
+        if report['counters'] != {}:
+            lines.append('')
+            lines.append('Caches:')
+            for name, count in report['counters'].items():
+                lines.append(f'{name:<40} {count:>10}')
+        return '\n'.join(lines)
+
+
+class SlowFiles:
+    '''
+    Keeps the `count` files that took longest to scan, as outliers are what
+    makes a run slow, and can re-run them under cProfile.
+    '''
+
+    def __init__(self, count, language_name):
+        self.count = count
+        self.language_name = language_name
+        self.heap = []  # min-heap of (seconds, order, entry)
+        self.seen = 0
+
+    def add(self, source, hits):
+        entry = {
+            'path': source.path,
+            'seconds': round(source.scan_seconds, 6),
+            'size': source.size,
+            'language': self.language_name,
+            'hits': hits,
+        }
+        item = (source.scan_seconds, self.seen, entry)
+        self.seen += 1
+        if len(self.heap) < self.count:
+            heapq.heappush(self.heap, item)
+        elif item[0] > self.heap[0][0]:
+            heapq.heapreplace(self.heap, item)
+
+    def slowest(self):
+        return [entry for _, _, entry in sorted(self.heap, key=lambda item: (-item[0], item[1]))]
+
+    def format_report(self):
+        lines = [f'Slowest files (of {self.seen}):']
+        for entry in self.slowest():
+            lines.append(f'{entry["seconds"]:>9.3f}s {entry["size"] / 1024:>10.1f} KB {entry["hits"]:>6} hits  '
+                         f'{entry["language"]:<10} {entry["path"]}')
+        return '\n'.join(lines)
+
+    def dump_profiles(self, assistant, directory):
+        '''
+        Scan the slowest files again under cProfile, bypassing the findings
+        cache, and write a .prof dump for each into `directory`.
+        Return the paths of the dumps.
+        '''
+        os.makedirs(directory, exist_ok=True)
+        cache, profiler = assistant.cache, assistant.profiler
+        assistant.cache, assistant.profiler = None, None
+        dumps = []
+        try:
+            for rank, entry in enumerate(self.slowest()):
+                profile = cProfile.Profile()
+                try:
+                    profile.runcall(assistant.process_file, entry['path'])
+                except OSError:
+                    continue  # removed since
+                name = re.sub(r'[^\w.-]', '_', os.path.basename(entry['path']))
+                dump_path = os.path.join(directory, f'{rank+1:02d}-{name}.prof')
+                profile.dump_stats(dump_path)
+                dumps.append(dump_path)
+        finally:
+            assistant.cache, assistant.profiler = cache, profiler
+        return dumps
+
+
+class MemoryTracer:
+    '''
+    Measures memory use per phase of each file's scan (load, tree, captures,
+    render) and per file, with tracemalloc for Python allocations and the
+    resident set size for everything else, like tree-sitter trees, which are
+    allocated by the C library.
+
+    Peaks are relative to memory in use when the phase or file started.
+    Only sequential scans are traced, so that peaks can be attributed.
+    '''
+
+    def __init__(self, count=10):
+        self.count = count
+        self.phases = {}  # phase -> [peak traced bytes, peak rss growth]
+        self.files = []  # min-heap of (peak traced bytes, order, entry)
+        self.seen = 0
+        self.peak_rss = current_rss()
+        self.peak_traced = 0  # tracemalloc's own peak is reset by each phase
+        self.file_start = None
+        self.file_peak = 0
+        tracemalloc.start()
+
+    def begin(self):
+        tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0], current_rss()
+
+    def end(self, phase, state):
+        current, peak = tracemalloc.get_traced_memory()
+        rss = current_rss()
+        start, start_rss = state
+        entry = self.phases.setdefault(phase, [0, 0])
+        entry[0] = max(entry[0], peak - start)
+        entry[1] = max(entry[1], rss - start_rss)
+        self.file_peak = max(self.file_peak, peak)
+        self.peak_rss = max(self.peak_rss, rss)
+        self.peak_traced = max(self.peak_traced, peak)
+
+    def begin_file(self):
+        self.file_start = self.begin()
+        self.file_peak = self.file_start[0]
+
+    def end_file(self, source, hits):
+        start, start_rss = self.file_start
+        entry = {
+            'path': source.path,
+            'size': source.size,
+            'hits': hits,
+            'peak_traced': self.file_peak - start,
+            'rss_growth': current_rss() - start_rss,
+        }
+        item = (entry['peak_traced'], self.seen, entry)
+        self.seen += 1
+        if len(self.files) < self.count:
+            heapq.heappush(self.files, item)
+        elif item[0] > self.files[0][0]:
+            heapq.heapreplace(self.files, item)
+
+    def format_report(self):
+        mb = 1024 * 1024
+        lines = [f'Memory: peak RSS {self.peak_rss / mb:.1f} MB, '
+                 f'peak traced by Python {self.peak_traced / mb:.1f} MB', '']
+        lines.append(f'{"phase":<12} {"peak traced (MB)":>17} {"RSS growth (MB)":>16}')
+        for phase in MEMORY_PHASES:
+            if phase in self.phases:
+                peak, rss_growth = self.phases[phase]
+                lines.append(f'{phase:<12} {peak / mb:>17.2f} {rss_growth / mb:>16.2f}')
+        lines.append('')
+        lines.append(f'Files with the biggest peaks (of {self.seen}):')
+        for _, _, entry in sorted(self.files, key=lambda item: (-item[0], item[1])):
+            lines.append(f'{entry["peak_traced"] / mb:>9.2f} MB traced {entry["rss_growth"] / mb:>8.2f} MB RSS '
+                         f'{entry["size"] / 1024:>10.1f} KB {entry["hits"]:>6} hits  {entry["path"]}')
+        return '\n'.join(lines)
+
+
+def current_rss():
+    '''
+    Resident set size of this process, in bytes. Where /proc isn't
+    available, fall back to the peak resident set size so far.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        if resource == None:
+            return 0
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
@@ -0,0 +1,74 @@
+import click
+import html
+
+
+class PlainRenderer:
+    '''
+    Renders text with no styling at all.
+    Renderers expose style(), for text with the given click-like styles, and
+    escape(), for unstyled text that comes from sources or changelogs.
+    '''
+
+    header = ''
+    footer = ''
+
+    def style(self, text, fg=None, bg=None, bold=False):
+        return str(text)
+
+    def escape(self, text):
+        return text
+
+
+class AnsiRenderer(PlainRenderer):
+    '''
+    Renders styles as ANSI escape sequences, for terminals.
+    '''
+
+    def style(self, text, fg=None, bg=None, bold=False):
+        return click.style(str(text), fg=fg, bg=bg, bold=bold or None)
+
+
+class HtmlRenderer(PlainRenderer):
+    '''
+    Renders a preformatted HTML page, with styles as inline CSS.
+    '''
+
+    header = '<!DOCTYPE html>\n<html>\n<head><meta charset="utf-8"></head>\n<body>\n<pre>'
+    footer = '</pre>\n</body>\n</html>'
+    css_colors = {
+        'blue': 'blue',
+        'green': 'green',
+        'cyan': 'darkcyan',
+        'bright_yellow': 'darkgoldenrod',
+        'bright_red': 'red',
+    }
+
+    def style(self, text, fg=None, bg=None, bold=False):
+        css = ''
+        if fg != None:
+            css += f'color: {self.css_colors.get(fg, fg)};'
+        if bg != None:
+            css += f'background-color: {self.css_colors.get(bg, bg)}; color: white;'
+        if bold:
+            css += 'font-weight: bold;'
+        text = html.escape(str(text), quote=False)
+        if css == '':
+            return text
+        return f'<span style="{css}">{text}</span>'
+
+    def escape(self, text):
+        return html.escape(text, quote=False)
+
+
+def get_renderer(name, stream):
+    '''
+    Pick a renderer once for the whole run. `auto` styles output with ANSI
+    codes only when `stream` is a terminal.
+    '''
+    if name == 'auto':
+        name = 'ansi' if stream.isatty() else 'plain'
+    return {
+        'plain': PlainRenderer,
+        'ansi': AnsiRenderer,
+        'html': HtmlRenderer,
+    }[name]()
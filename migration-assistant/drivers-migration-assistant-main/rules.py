@@ -0,0 +1,108 @@
+import json
+import re
+import os
+from hashlib import sha256
+from packaging.version import Version
+
+from parsers import format_pattern_string
+from prefilter import LiteralMatcher, pattern_literals
+
+
+class Rule:
+    '''
+    A changelog entry, compiled against the target version.
+    Only entries that are deprecated or removed at that version become rules.
+    '''
+
+    def __init__(self, change, deprecated, removed):
+        self.change = change
+        self.identifier = change.get('identifier')
+        self.patterns = change['patterns']
+        self.deprecated = deprecated
+        self.removed = removed
+        self.msg = change['msg'].format(**change)
+        self.refs = change.get('ref')
+        if isinstance(self.refs, str):
+            self.refs = [self.refs, ]  # make iterable
+        elif self.refs == None:
+            self.refs = []
+        # per pattern, literals a file must contain for its query to match anything
+        self.literals = [pattern_literals(ts_pattern_regexes(pattern, change)) for pattern in self.patterns]
+
+
+class RuleSet:
+    '''
+    Changelog for a language, parsed and filtered once per run and shared by
+    every file scan.
+    '''
+
+    def __init__(self, language_name, version):
+        self.language_name = language_name
+        self.version = version
+        self.path = os.path.join(os.path.dirname(__file__), 'changelogs', f'{language_name}.json')
+        with open(self.path, 'rb') as f:
+            changelog = f.read()
+        self.digest = sha256(changelog).hexdigest()
+        changes_json = json.loads(changelog)
+
+        self.rules = []
+        for change in changes_json:
+            deprecated = self.reached(change.get('deprecated'))
+            removed = self.reached(change.get('removed'))
+            if not deprecated and not removed:
+                continue
+            self.validate_patterns(change)
+            self.rules.append(Rule(change, deprecated, removed))
+        self.rules_by_id = {rule.identifier: rule for rule in self.rules}
+        self.literal_matcher = LiteralMatcher(
+            literal for rule in self.rules for clauses in rule.literals
+            for clause in clauses for literal in clause)
+
+    def get(self, identifier):
+        return self.rules_by_id.get(identifier)
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def reached(self, version_s):
+        return version_s != None and Version(version_s) <= self.version
+
+    def validate_patterns(self, change):
+        '''
+        Fail at start-up, rather than halfway through a scan, on patterns
+        that can't be compiled.
+        '''
+        for pattern in change['patterns']:
+            ts_pattern = pattern.get('ts_pattern')
+            if isinstance(ts_pattern, str):
+                ts_pattern = [ts_pattern, ]
+            for p in ts_pattern or []:
+                p = format_pattern_string(p, change, {})
+                if p.startswith('?!'):
+                    p = p[2:]
+                self.compile_regex(p, change)
+            if pattern.get('re_pattern') != None:
+                self.compile_regex(pattern['re_pattern'], change)
+
+    def compile_regex(self, regex, change):
+        try:
+            return re.compile(regex)
+        except re.error as e:
+            raise ValueError(f'Change `{change.get("identifier")}` has invalid pattern `{regex}`: {e}')
+
+
+def ts_pattern_regexes(pattern, change):
+    '''
+    A pattern's ts_pattern regexes as plain regexes: with query string
+    escaping undone, and namespaces left open, as files may alias them.
+    '''
+    ts_pattern = pattern.get('ts_pattern')
+    if isinstance(ts_pattern, str):
+        ts_pattern = [ts_pattern, ]
+    namespaces = {}
+    if change.get('namespace') != None:
+        namespaces[change['namespace']] = '(?:.*)'
+    return [format_pattern_string(p, change, namespaces).replace('\\\\', '\\') for p in ts_pattern or []]
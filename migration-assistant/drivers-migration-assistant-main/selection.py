@@ -0,0 +1,181 @@
+import os
+import re
+
+
+LANGUAGE_EXTENSIONS = {
+    'python': ('.py', ),
+    'go': ('.go', ),
+    'javascript': ('.js', '.mjs', '.cjs'),
+}
+
+
+class IgnoreRules:
+    '''
+    Patterns in .gitignore syntax, as read from a .gitignore file or given
+    with --exclude. Paths are matched relative to the directory the rules
+    are defined in, using '/' as separator.
+    '''
+
+    def __init__(self, lines):
+        self.rules = []
+        for line in lines:
+            line = line.rstrip('\n').rstrip()
+            if line == '' or line.startswith('#'):
+                continue
+            negate = line.startswith('!')
+            if negate:
+                line = line[1:]
+            elif line.startswith('\\'):  # escaped leading ! or #
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            if line == '':
+                continue
+            anchored = '/' in line
+            regex = gitignore_to_regex(line.lstrip('/'))
+            if not anchored:
+                regex = '(?:.*/)?' + regex
+            self.rules.append((re.compile(regex + '$'), negate, dir_only))
+
+    @classmethod
+    def from_file(cls, path):
+        try:
+            with open(path, errors='replace') as f:
+                return cls(f.readlines())
+        except OSError:
+            return None
+
+    def match(self, rel_path, is_dir):
+        '''
+        True if the path is ignored, False if re-included by a negated
+        pattern, None if no pattern applies. The last matching pattern wins.
+        '''
+        for regex, negate, dir_only in reversed(self.rules):
+            if dir_only and not is_dir:
+                continue
+            if regex.match(rel_path):
+                return not negate
+        return None
+
+
+class FileSelector:
+    '''
+    Decides which files found by walking directories get scanned:
+    files with the language's extensions, not matched by --exclude patterns
+    and, unless disabled, not ignored by the project's .gitignore files.
+
+    Ignore rules are tracked as a list of (IgnoreRules, prefix) pairs, where
+    prefix is the path from the rules' directory to the directory being
+    walked, so that whole ignored subtrees are skipped without being entered.
+    '''
+
+    def __init__(self, language_name, excludes=(), use_gitignore=True):
+        self.extensions = LANGUAGE_EXTENSIONS.get(language_name, ())
+        self.excludes = IgnoreRules(excludes) if excludes else None
+        self.use_gitignore = use_gitignore
+
+    def root_rules(self, top):
+        '''
+        Ignore rules in effect at the walk root `top`: --exclude patterns,
+        relative to `top`, and the .gitignore files of its ancestors up to the
+        repository root.
+        '''
+        rules = []
+        if self.excludes != None:
+            rules.append((self.excludes, ''))
+        if not self.use_gitignore:
+            return rules
+
+        ancestors = []
+        dir_path = os.path.realpath(top or '.')
+        while True:
+            parent = os.path.dirname(dir_path)
+            if os.path.exists(os.path.join(dir_path, '.git')) or parent == dir_path:
+                break
+            dir_path = parent
+            ancestors.append(dir_path)
+        if not os.path.exists(os.path.join(dir_path, '.git')):
+            return rules  # not in a repository: only .gitignore files below top apply
+
+        real_top = os.path.realpath(top or '.')
+        for ancestor in reversed(ancestors):
+            ignore_rules = IgnoreRules.from_file(os.path.join(ancestor, '.gitignore'))
+            if ignore_rules != None:
+                prefix = os.path.relpath(real_top, ancestor).replace(os.sep, '/') + '/'
+                rules.append((ignore_rules, prefix))
+        return rules
+
+    def dir_rules(self, dir_path, parent_rules, name=None):
+        '''
+        Ignore rules in effect inside `dir_path`, given those of its parent
+        (or those at the walk root, when `name` is None).
+        '''
+        if name == None:
+            rules = list(parent_rules)
+        else:
+            rules = [(ignore_rules, prefix + name + '/') for ignore_rules, prefix in parent_rules]
+        if self.use_gitignore:
+            ignore_rules = IgnoreRules.from_file(os.path.join(dir_path or '.', '.gitignore'))
+            if ignore_rules != None:
+                rules.append((ignore_rules, ''))
+        return rules
+
+    def is_ignored(self, name, is_dir, rules):
+        ignored = None
+        for ignore_rules, prefix in rules:
+            match = ignore_rules.match(prefix + name, is_dir)
+            if ignore_rules is self.excludes:
+                if match == True:
+                    return True  # .gitignore negations can't bring back what --exclude drops
+                continue
+            if match != None:
+                ignored = match
+        return ignored == True
+
+    def has_extension(self, name):
+        return name.endswith(self.extensions)
+
+    def is_excluded(self, path):
+        '''
+        Whether --exclude patterns match a path not found by walking
+        (an explicit file, or a glob result).
+        '''
+        if self.excludes == None:
+            return False
+        parts = os.path.normpath(path).replace(os.sep, '/').split('/')
+        return any(
+            self.excludes.match('/'.join(parts[:i+1]), i < len(parts) - 1)
+            for i in range(len(parts))
+        )
+
+
+def gitignore_to_regex(pattern):
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+            continue
+        if pattern.startswith('**', i) and i + 2 == len(pattern):
+            regex += '.*'
+            break
+        c = pattern[i]
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[' and pattern.find(']', i+2) != -1:
+            end = pattern.find(']', i+2)
+            chars = pattern[i+1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            regex += '[' + chars.replace('\\', '\\\\') + ']'
+            i = end
+        elif c == '\\' and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        else:
+            regex += re.escape(c)
+        i += 1
+    return regex
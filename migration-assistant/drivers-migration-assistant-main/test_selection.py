@@ -0,0 +1,20 @@
+import os
+
+from selection import FileSelector
+from utils import parse_path
+
+
+def scanned(top, *excludes):
+    selector = FileSelector('javascript', excludes)
+    return sorted(os.path.relpath(path, top) for path in parse_path([str(top)], selector))
+
+
+def test_exclude_overrides_gitignore_negation(tmp_path):
+    (tmp_path / '.git').mkdir()
+    (tmp_path / '.gitignore').write_text('*.min.js\n!keep.min.js\n')
+    for name in ('app.js', 'lib.min.js', 'keep.min.js'):
+        (tmp_path / name).write_text('const neo4j = require("neo4j-driver")\n')
+
+    assert scanned(tmp_path) == ['app.js', 'keep.min.js']
+    assert scanned(tmp_path, '*.min.js') == ['app.js']
+    assert scanned(tmp_path, 'keep*') == ['app.js']
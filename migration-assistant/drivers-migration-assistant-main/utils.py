@@ -1,7 +1,19 @@
+from array import array
+from bisect import bisect_right
 from hashlib import sha256
 import click
-from glob import iglob
+import mmap
+from glob import iglob, has_magic
 import os.path
+import re
+import subprocess
+import threading
+from queue import Queue
+from stat import S_ISREG
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 
 class Color:
@@ -12,33 +24,465 @@ class Color:
     file = 'green'
 
 
+# e.g. `# neo4j-migrate: ignore` or `// neo4j-migrate: ignore[last_bookmark, hydrate]`
+SUPPRESSION_MARKER = b'neo4j-migrate:'
+SUPPRESSION_RE = re.compile(rb'(?:#|//)\s*neo4j-migrate:\s*ignore(?:\[([^\]\n]*)\])?')
+
+# files larger than this are memory-mapped rather than read
+MMAP_THRESHOLD = 1024 * 1024
+# how much of a file to inspect to tell whether it's worth parsing
+SNIFF_SIZE = 8192
+# mean line length above which a file is deemed minified or generated
+MINIFIED_LINE_LENGTH = 500
+
+
 class File:
+    '''
+    Source file to scan. The content is held once, as utf8 bytes, and handed
+    as such to parsers. Lines are sliced out of it and decoded on demand,
+    through an index of line start offsets built on first use.
+    Offsets and (row, col) points are in bytes, as with tree-sitter.
+    '''
+
     def __init__(self, file_path):
         self.path = file_path
-        self.text = open(file_path).read()
-        self.lines = self.text.split('\n')
+        self._data = read_bytes(file_path)
+        self.size = len(self._data)
+        self._line_starts = None
         self.deprecated_count = 0
         self.removed_count = 0
+        self._suppressions = None
+        # why the file was skipped, or scanned with the regex parser only
+        self.skipped = None
+        self.downgraded = None
+        # False if no changelog pattern can match, so the file wasn't parsed
+        self.relevant = True
+        # wall time taken by the scan, including parsing
+        self.scan_seconds = 0
+
+    def sniff(self, max_size=0):
+        '''
+        Cheap check of whether the file is worth parsing, looking at its size
+        and first few KB only. Return None if so, otherwise the reason why not:
+        'binary', 'too large' or 'minified'.
+        '''
+        head = self.data[:SNIFF_SIZE]
+        if b'\0' in head:
+            return 'binary'
+        if max_size and len(self.data) > max_size:
+            return 'too large'
+        if len(head) / (head.count(b'\n') + 1) > MINIFIED_LINE_LENGTH:
+            return 'minified'
+        return None
+
+    @property
+    def data(self):
+        if self._data == None:  # dropped when sent across processes
+            self._data = read_bytes(self.path)
+        return self._data
+
+    def contains(self, needle):
+        '''
+        Whether the bytes `needle` occur in the file. Large files are mmaps,
+        which don't support `in`.
+        '''
+        return self.data.find(needle) != -1
+
+    @property
+    def line_starts(self):
+        if self._line_starts == None:
+            typecode = 'I' if len(self.data) < 2**32 else 'Q'
+            self._line_starts = array(typecode, [0])
+            self._line_starts.extend(m.end() for m in re.finditer(b'\n', self.data))
+        return self._line_starts
+
+    def line_count(self):
+        return len(self.line_starts)
+
+    def line_bytes(self, line_n):
+        '''
+        Content of line `line_n` (0-based), without line terminator (LF or CRLF).
+        '''
+        start = self.line_starts[line_n]
+        if line_n + 1 < len(self.line_starts):
+            line = self.data[start:self.line_starts[line_n+1]-1]
+        else:
+            line = self.data[start:]
+        if line.endswith(b'\r'):
+            line = line[:-1]
+        return line
+
+    def line(self, line_n):
+        return decode(self.line_bytes(line_n))
+
+    def char_col(self, line_n, byte_col):
+        '''
+        Convert a byte column on line `line_n` into a character column.
+        '''
+        return len(decode(self.line_bytes(line_n)[:byte_col]))
+
+    def point(self, offset):
+        '''
+        Convert a byte offset into a (row, col) tuple.
+        '''
+        line_n = bisect_right(self.line_starts, offset) - 1
+        return (line_n, offset - self.line_starts[line_n])
+
+    @property
+    def suppressions(self):
+        # found on first use, so skipped files are never searched
+        if self._suppressions == None:
+            self._suppressions = find_suppressions(self)
+        return self._suppressions
+
+    def is_suppressed(self, line_n, change_id):
+        '''
+        Whether a suppression comment on line `line_n` covers change `change_id`.
+        '''
+        if line_n not in self.suppressions:
+            return False
+        change_ids = self.suppressions[line_n]
+        return change_ids == None or change_id in change_ids
+
+    def __getstate__(self):
+        # only path and counters are sent back from worker processes;
+        # content is read again only if findings get rendered
+        state = self.__dict__.copy()
+        state['_data'] = None
+        state['_line_starts'] = None
+        return state
+
+
+def find_suppressions(source):
+    '''
+    Map line numbers to the change identifiers suppressed by an inline comment
+    on that line, or to None if all changes are suppressed there.
+    '''
+    suppressions = {}
+    if not source.contains(SUPPRESSION_MARKER):
+        return suppressions
+
+    for match in SUPPRESSION_RE.finditer(source.data):
+        line_n = source.point(match.start())[0]
+        if match.group(1) == None:
+            suppressions[line_n] = None
+        elif suppressions.get(line_n, set()) != None:
+            change_ids = suppressions.setdefault(line_n, set())
+            change_ids.update(change_id.strip() for change_id in decode(match.group(1)).split(','))
+    return suppressions
+
+
+def read_bytes(file_path):
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size > MMAP_THRESHOLD:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return f.read()
+
+
+def decode(data):
+    return data.decode('utf8', 'replace')
+
+
+class IgnoreStore:
+    '''
+    Hashes of ignored messages, loaded once into a set.
+    New hashes are buffered and appended by flush(), which holds an exclusive
+    lock on the file (where supported) so that concurrent runs don't interleave
+    or duplicate entries.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = []
+        self.hashes = self.read_hashes()
+
+    def read_hashes(self):
+        try:
+            with open(self.path) as f:
+                return set(h.strip() for h in f)
+        except FileNotFoundError:
+            return set()
+
+    def __contains__(self, msg_hash):
+        return msg_hash in self.hashes
+
+    def add(self, msg_hash):
+        if msg_hash in self.hashes:  # no double entries
+            return
+        self.hashes.add(msg_hash)
+        self.pending.append(msg_hash)
 
+    def flush(self):
+        if self.pending == []:
+            return
+        with open(self.path, 'a+') as f:
+            if fcntl != None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            # another run may have added some of the same hashes meanwhile
+            f.seek(0)
+            stored = set(h.strip() for h in f)
+            f.write(''.join(h + '\n' for h in self.pending if h not in stored))
+            f.flush()
+            if fcntl != None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        self.pending = []
 
-def hash_message(message, source):
+
+def hash_message(finding, source):
     #ex: example-projects/python/movies.py::import neo4j.Bookmark::import_neo4j.Bookmark
     to_hash = source.path.strip() + '::' + \
-              source.lines[message['meta']['line']].strip() + '::' + \
-              message['meta']['change_id'].strip()
+              source.line(finding.line).strip() + '::' + \
+              finding.change_id.strip()
     return sha256(to_hash.encode()).hexdigest()
 
 
-def parse_path(path):
+def parse_path(path, selector=None):
     '''
     Expand a path into paths to files. Supports globbing.
+    Paths are yielded lazily, as directories are walked, and each file is
+    yielded only once even if reachable through several paths or symlinks.
+    If a FileSelector is given, it filters files found by walking directories
+    (including ** globs), while other paths are only subject to its excludes.
+    '''
+    seen_dirs = set()
+    seen_files = set()
+    for file_path in path:
+        file_path = file_path.strip()
+        if os.path.isdir(file_path):  # expand dirs to include files and subdirs
+            file_entries = walk_files(file_path, seen_dirs, selector)
+        elif '**' in file_path:
+            matcher = re.compile(glob_to_regex(file_path))
+            base = glob_base(file_path)
+            file_entries = (
+                (p, key) for p, key in walk_files('' if base == '.' and not file_path.startswith('.') else base, seen_dirs, selector)
+                if matcher.match(p)
+            )
+        else:
+            file_entries = stat_files(iglob(file_path))
+            if selector != None:
+                file_entries = ((p, key) for p, key in file_entries if not selector.is_excluded(p))
+        for file_path, file_key in file_entries:
+            if file_key not in seen_files:
+                seen_files.add(file_key)
+                yield file_path
+
+
+def walk_files(top, seen_dirs, selector=None, rules=None):
     '''
+    Yield (path, (device, inode)) for each regular file below `top`, depth
+    first, skipping hidden entries as glob does. Relies on scandir's cached
+    entry types, so most files need no stat() call. Symlinked directories are
+    followed, but each directory is only walked once.
+    With a FileSelector, ignored directories are never entered and files
+    are filtered by extension; `rules` are the ignore rules in effect in `top`.
+    '''
+    try:
+        top_stat = os.stat(top or '.')
+    except OSError:
+        return
+    dir_key = (top_stat.st_dev, top_stat.st_ino)
+    if dir_key in seen_dirs:  # symlink loop, or already walked
+        return
+    seen_dirs.add(dir_key)
+
+    try:
+        with os.scandir(top or '.') as it:
+            entries = list(it)
+    except OSError:
+        return
+
+    if selector != None and rules == None:
+        rules = selector.dir_rules(top, selector.root_rules(top))
+
+    subdirs = []
+    for entry in entries:
+        if entry.name.startswith('.'):
+            continue
+        path = os.path.join(top, entry.name) if top else entry.name
+        try:
+            is_dir = entry.is_dir()
+            if selector != None and selector.is_ignored(entry.name, is_dir, rules):
+                continue
+            if is_dir:
+                subdirs.append((path, entry.name))
+                continue
+            if not entry.is_file():
+                continue
+            if selector != None and not selector.has_extension(entry.name):
+                continue
+            if entry.is_symlink():
+                stat = entry.stat()
+                file_key = (stat.st_dev, stat.st_ino)
+            else:
+                file_key = (top_stat.st_dev, entry.inode())
+        except OSError:
+            continue
+        yield path, file_key
+
+    for subdir, name in subdirs:
+        subdir_rules = selector.dir_rules(subdir, rules, name) if selector != None else None
+        yield from walk_files(subdir, seen_dirs, selector, subdir_rules)
+
+
+def stat_files(file_paths):
+    '''
+    Yield (path, (device, inode)) for the paths pointing to regular files.
+    '''
+    for file_path in file_paths:
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            continue
+        if S_ISREG(stat.st_mode):
+            yield file_path, (stat.st_dev, stat.st_ino)
+
+
+def prefetch(iterable, maxsize):
+    '''
+    Iterate over `iterable` in a background thread, staying at most `maxsize`
+    items ahead of the consumer. Exceptions are re-raised to the consumer.
+    '''
+    queue = Queue(maxsize)
+
+    def produce():
+        try:
+            for item in iterable:
+                queue.put((True, item))
+        except BaseException as e:
+            queue.put((False, e))
+        else:
+            queue.put((False, None))
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        is_item, item = queue.get()
+        if not is_item:
+            if item != None:
+                raise item
+            return
+        yield item
+
+
+def parse_path_since(path, ref, selector=None):
+    '''
+    Like parse_path, but only return files that were added or changed relative
+    to git `ref` (including uncommitted and untracked files), as reported by
+    the local git repository containing each path. No globbing over the
+    filesystem takes place, so it's cheap regardless of the repository size.
+    '''
+    changed_by_repo = {}
+    seen_files = set()
     file_paths = []
     for file_path in path:
-        if os.path.isdir(file_path.strip()):  # expand dirs to include files and subdirs
+        file_path = file_path.strip()
+        if os.path.isdir(file_path):
             file_path = os.path.join(file_path, '**', '*')
-        all_file_paths = iglob(file_path.strip(), recursive=True)
-        for path in all_file_paths:
-            if not os.path.isdir(path):  # ignore dir paths, as they've been expanded into their files
-                file_paths.append(path)
+        repo_root = git_toplevel(glob_base(file_path))
+        if changed_by_repo.get(repo_root) == None:
+            changed_by_repo[repo_root] = git_changed_files(repo_root, ref)
+
+        matcher = re.compile(glob_to_regex(os.path.realpath(file_path)))
+        for changed_path in changed_by_repo[repo_root]:
+            if not matcher.match(changed_path) or not os.path.isfile(changed_path):
+                continue
+            if changed_path in seen_files:  # overlapping paths
+                continue
+            seen_files.add(changed_path)
+            changed_path = display_path(changed_path)
+            if selector != None and (not selector.has_extension(changed_path) or selector.is_excluded(changed_path)):
+                continue
+            file_paths.append(changed_path)
     return file_paths
+
+
+def git(repo_dir, *args):
+    try:
+        result = subprocess.run(
+            ['git', '-C', repo_dir, *args],
+            capture_output=True, text=True, check=True)
+    except FileNotFoundError:
+        raise click.ClickException('`--since` requires git to be installed.')
+    except subprocess.CalledProcessError as e:
+        raise click.ClickException(f'git {" ".join(args)} failed in `{repo_dir}`: {e.stderr.strip()}')
+    return result.stdout
+
+
+def git_toplevel(dir_path):
+    return git(dir_path, 'rev-parse', '--show-toplevel').strip()
+
+
+def git_changed_files(repo_root, ref):
+    '''
+    Real paths of files added, copied, modified or renamed since the merge base
+    of `ref` and HEAD, plus untracked (non-ignored) files.
+    '''
+    merge_base = git(repo_root, 'merge-base', ref, 'HEAD').strip()
+    changed = git(repo_root, 'diff', '--name-only', '-z', '--no-renames', '--diff-filter=ACMR', merge_base)
+    untracked = git(repo_root, 'ls-files', '-z', '--others', '--exclude-standard')
+    rel_paths = [p for p in (changed + untracked).split('\0') if p != '']
+    return [os.path.realpath(os.path.join(repo_root, p)) for p in rel_paths]
+
+
+def glob_base(pattern):
+    '''
+    Longest leading directory of a glob pattern that contains no magic.
+    '''
+    base = []
+    for part in pattern.split(os.sep):
+        if has_magic(part):
+            break
+        base.append(part)
+    base = os.sep.join(base)
+    if not os.path.isdir(base):
+        base = os.path.dirname(base)
+    return base or '.'
+
+
+def glob_to_regex(pattern):
+    '''
+    Translate a glob pattern, with iglob(recursive=True) semantics, to a regex
+    matching full paths. Wildcards don't match hidden files, like in glob.
+    '''
+    regex = ''
+    parts = pattern.split(os.sep)
+    for i, part in enumerate(parts):
+        last = i == len(parts) - 1
+        if part == '**':
+            if last:
+                regex += '(?!\\.)[^/]*(?:/(?!\\.)[^/]*)*'
+            else:
+                regex += '(?:(?!\\.)[^/]*/)*'
+            continue
+        if part[:1] in ('*', '?', '['):
+            regex += '(?!\\.)'
+        j = 0
+        while j < len(part):
+            c = part[j]
+            if c == '*':
+                regex += '[^/]*'
+            elif c == '?':
+                regex += '[^/]'
+            elif c == '[' and part.find(']', j+2) != -1:
+                end = part.find(']', j+2)
+                chars = part[j+1:end]
+                if chars.startswith('!'):
+                    chars = '^' + chars[1:]
+                regex += '[' + chars.replace('\\', '\\\\') + ']'
+                j = end
+            else:
+                regex += re.escape(c)
+            j += 1
+        if not last:
+            regex += '/'
+    return regex + '$'
+
+
+def display_path(real_path):
+    '''
+    Path relative to the working directory when below it, otherwise absolute.
+    '''
+    rel_path = os.path.relpath(real_path)
+    if rel_path.startswith(os.pardir + os.sep):
+        return real_path
+    return rel_path
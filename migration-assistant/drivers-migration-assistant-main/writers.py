@@ -0,0 +1,122 @@
+import json
+import os
+
+
+class JsonLinesWriter:
+    '''
+    Writes one JSON object per finding, one per line, as files get scanned.
+    Lines and columns are 1-based; columns count characters.
+    '''
+
+    def __init__(self, stream, rules):
+        self.stream = stream
+        self.rules = rules
+
+    def write_file(self, source, findings):
+        for finding in findings:
+            rule = self.rules.get(finding.change_id)
+            self.stream.write(json.dumps({
+                'file': source.path,
+                'line': finding.line + 1,
+                'col_start': finding.col_start + 1,
+                'col_end': finding.col_end + 1,
+                'change_id': finding.change_id,
+                'severity': finding.severity,
+                'message': rule.msg,
+                'deprecated_in': rule.change.get('deprecated'),
+                'removed_in': rule.change.get('removed'),
+                'refs': rule.refs,
+                'hash': finding.hash
+            }) + '\n')
+        self.stream.flush()
+
+    def close(self):
+        self.stream.flush()
+
+
+class SarifWriter:
+    '''
+    Writes a SARIF 2.1.0 log, for code scanning dashboards.
+    The document is streamed: the run header goes out first, results are
+    appended as files get scanned, and close() terminates the document.
+    '''
+
+    def __init__(self, stream, rules):
+        self.stream = stream
+        self.rules = rules
+        self.rule_indexes = {rule.identifier: i for i, rule in enumerate(rules)}
+        self.first_result = True
+
+        run = {
+            'tool': {
+                'driver': {
+                    'name': 'neo4j-drivers-migration-assistant',
+                    'informationUri': f'https://neo4j.com/docs/{rules.language_name}-manual/current/migration/',
+                    'rules': [self.sarif_rule(rule) for rule in rules]
+                }
+            },
+            'columnKind': 'unicodeCodePoints',
+            'results': []
+        }
+        header = json.dumps({
+            '$schema': 'https://json.schemastore.org/sarif-2.1.0.json',
+            'version': '2.1.0',
+            'runs': [run]
+        })
+        # leave the results array open, to append to it
+        self.tail = header[header.rindex('[]')+1:]
+        self.stream.write(header[:header.rindex('[]')+1])
+        self.stream.flush()
+
+    def sarif_rule(self, rule):
+        sarif_rule = {
+            'id': rule.identifier,
+            'shortDescription': {'text': rule.msg},
+            'defaultConfiguration': {'level': self.level(rule.removed)},
+            'properties': {
+                'deprecated_in': rule.change.get('deprecated'),
+                'removed_in': rule.change.get('removed')
+            }
+        }
+        if rule.refs != []:
+            sarif_rule['helpUri'] = rule.refs[0]
+        return sarif_rule
+
+    def level(self, removed):
+        return 'error' if removed else 'warning'
+
+    def write_file(self, source, findings):
+        uri = source.path.replace(os.sep, '/')
+        for finding in findings:
+            region = {
+                'startLine': finding.line + 1,
+                'startColumn': finding.col_start + 1
+            }
+            if finding.col_end > finding.col_start:  # hits spanning lines only get a start
+                region['endColumn'] = finding.col_end + 1
+            result = json.dumps({
+                'ruleId': finding.change_id,
+                'ruleIndex': self.rule_indexes[finding.change_id],
+                'level': self.level(finding.removed),
+                'message': {'text': self.rules.get(finding.change_id).msg},
+                'locations': [{
+                    'physicalLocation': {
+                        'artifactLocation': {'uri': uri},
+                        'region': region
+                    }
+                }],
+                'partialFingerprints': {'neo4jMigrationHash/v1': finding.hash}
+            })
+            self.stream.write(('' if self.first_result else ',') + '\n' + result)
+            self.first_result = False
+        self.stream.flush()
+
+    def close(self):
+        self.stream.write('\n' + self.tail + '\n')
+        self.stream.flush()
+
+
+WRITERS = {
+    'jsonl': JsonLinesWriter,
+    'sarif': SarifWriter,
+}